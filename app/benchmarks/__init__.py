@@ -0,0 +1 @@
+"""init"""
@@ -0,0 +1,62 @@
+"""Microbenchmark comparing the batched roster diff with the old list comprehension.
+Run from the app directory: python -m benchmarks.bench_diff"""
+import argparse
+import random
+import timeit
+
+from models import Clan, Member
+from utils.diff import diff_batch
+
+def make_batch(no_clans: int, clan_size: int, churn: float) -> tuple[list[Clan], list[Clan]]:
+    """Create a batch of clans before and after a poll"""
+    old, new = [], []
+    next_id = 500000000
+    for clan_id in range(no_clans):
+        members = [Member(account_name=f"player{next_id + i}", account_id=next_id + i, role="private")
+                   for i in range(clan_size)]
+        next_id += clan_size
+        stayed = [x for x in members if random.random() > churn]
+        joined = [Member(account_name=f"player{next_id + i}", account_id=next_id + i, role="recruit")
+                  for i in range(clan_size - len(stayed))]
+        next_id += len(joined)
+        old.append(Clan(name=f"clan{clan_id}", clan_id=clan_id, members=members))
+        new.append(Clan(name=f"clan{clan_id}", clan_id=clan_id, members=stayed + joined))
+    return old, new
+
+def list_comprehension(old: list[Clan], new: list[Clan]) -> int:
+    """Leavers as computed before the diff engine"""
+    found = 0
+    for clan, tmpclan in zip(old, new):
+        if clan.members != tmpclan.members:
+            found += len([x for x in clan.members if x not in tmpclan.members])
+    return found
+
+def batched(old: list[Clan], new: list[Clan]) -> int:
+    """Leavers as computed by the diff engine, old rosters are cached on the stored clans"""
+    for clan in new:
+        clan.__dict__.pop("roster", None)
+    diffs = diff_batch([str(x.clan_id) for x in old],
+                       [x.roster for x in old],
+                       [x.roster for x in new],
+                       [x.is_clan_disbanded for x in old],
+                       [x.is_clan_disbanded for x in new])
+    return sum(len(x.left) for x in diffs)
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(prog="bench_diff")
+    parser.add_argument("--clans", type=int, default=100, help="Clans per API response")
+    parser.add_argument("--clan-size", type=int, default=100, help="Members per clan")
+    parser.add_argument("--churn", type=float, default=0.05, help="Fraction of members leaving")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    old, new = make_batch(args.clans, args.clan_size, args.churn)
+    assert list_comprehension(old, new) == batched(old, new)
+    for name, func in (("list comprehension", list_comprehension), ("batched diff", batched)):
+        seconds = min(timeit.repeat(lambda f=func: f(old, new), number=1, repeat=args.repeat))
+        print(f"{name:>20}: {seconds * 1000:8.3f} ms per response")
+
+if __name__ == "__main__":
+    main()
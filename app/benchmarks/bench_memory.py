@@ -0,0 +1,60 @@
+"""Benchmark the memory held by the clan state, comparing read_file with the compact state.
+Run from the app directory: python -m benchmarks.bench_memory [--clans 200000]"""
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+
+from models import Clan, Member
+from utils.storage import read_file, store_file
+from utils.state import CompactClans
+
+def synthetic_database(filename: str, no_clans: int, clan_size: int) -> None:
+    """Store clans with full member lists, written in chunks to keep the generator small"""
+    next_id = 500000000
+    chunk = 5000
+    for start in range(1, no_clans + 1, chunk):
+        clans = {}
+        for clan_id in range(start, min(start + chunk, no_clans + 1)):
+            members = [Member(account_name=f"player{next_id + i}", account_id=next_id + i,
+                              role="private") for i in range(clan_size)]
+            next_id += clan_size
+            clans[str(clan_id)] = Clan(name=f"clan{clan_id}", clan_id=clan_id, tag=f"C{clan_id}",
+                                       members_count=clan_size, description="a clan " * 50,
+                                       members=members, updated_at=1700000000)
+        store_file(clans, filename, "sqlite")
+
+def measure(load) -> tuple[float, int]:
+    """Seconds to load and bytes still allocated once loaded"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    clans = load()
+    seconds = time.perf_counter() - start
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del clans
+    return seconds, retained
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(prog="bench_memory")
+    parser.add_argument("--clans", type=int, default=20000)
+    parser.add_argument("--clan-size", type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "clans.db")
+        synthetic_database(filename, args.clans, args.clan_size)
+        print(f"{args.clans} clans of {args.clan_size} members, "
+              f"{os.path.getsize(filename) / 2**20:.0f} MiB database")
+        for name, load in (("read_file", lambda: read_file(filename, "sqlite")),
+                           ("compact state", lambda: CompactClans(filename).load())):
+            seconds, retained = measure(load)
+            print(f"{name:>14}: {retained / 2**20:8.1f} MiB retained, loaded in {seconds:.1f} s")
+
+if __name__ == "__main__":
+    main()
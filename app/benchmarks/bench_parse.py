@@ -0,0 +1,80 @@
+"""Benchmark the CPU spent on a 100 clan member response, comparing building
+pydantic models for every clan with the raw JSON fast path.
+Run from the app directory: python -m benchmarks.bench_parse [--response recorded.json]"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from models import Clan
+from utils.fetcher import json_loads
+from utils.parser import parse_members
+
+def synthetic_response(no_clans: int, clan_size: int) -> bytes:
+    """Response of clans/info with full member lists"""
+    data = {}
+    next_id = 500000000
+    for clan_id in range(1, no_clans + 1):
+        members = [{"account_name": f"player{next_id + i}", "account_id": next_id + i,
+                    "role": "private", "joined_at": 1600000000}
+                   for i in range(clan_size)]
+        next_id += clan_size
+        data[str(clan_id)] = {"name": f"clan{clan_id}", "clan_id": clan_id, "tag": f"C{clan_id}",
+                              "is_clan_disbanded": False, "old_name": "",
+                              "members_count": clan_size, "description": "a clan " * 50,
+                              "members": members, "updated_at": 1700000000}
+    return json.dumps({"status": "ok", "meta": {"count": no_clans}, "data": data}).encode()
+
+def stored_state(data: dict, changed: float) -> dict[Clan]:
+    """Clans as stored before the poll, a fraction of them lost a member since"""
+    clans = {}
+    for clan_id, entry in data.items():
+        entry = dict(entry)
+        if random.random() < changed:
+            departed = {"account_name": "departed", "account_id": 1, "role": "private"}
+            entry["members"] = entry["members"] + [departed]
+        clans[clan_id] = Clan(**entry)
+        clans[clan_id].roster # pylint: disable=pointless-statement
+    return clans
+
+def models_for_every_clan(body: bytes, clans: dict[Clan]) -> None:
+    """What every poll cost before the fast path"""
+    data = json.loads(body)["data"]
+    for clan_id, entry in data.items():
+        clans[clan_id] = Clan(**entry)
+
+def fast_path(body: bytes, clans: dict[Clan]) -> None:
+    """Current parser"""
+    data = json_loads(body)["data"]
+    asyncio.run(parse_members(data, asyncio.Queue(), clans))
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(prog="bench_parse")
+    parser.add_argument("--response", type=str, help="Recorded clans/info response, synthetic when omitted")
+    parser.add_argument("--clans", type=int, default=100)
+    parser.add_argument("--clan-size", type=int, default=50)
+    parser.add_argument("--changed", type=float, default=0.05, help="Fraction of clans that changed")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(0)
+    if args.response:
+        with open(args.response, "rb") as file:
+            body = file.read()
+    else:
+        body = synthetic_response(args.clans, args.clan_size)
+    data = json.loads(body)["data"]
+    print(f"response: {len(data)} clans, {len(body)} bytes")
+    for name, func in (("models for every clan", models_for_every_clan), ("raw json fast path", fast_path)):
+        cpu = 0.0
+        for _ in range(args.repeat):
+            clans = stored_state(data, args.changed)
+            start = time.process_time()
+            func(body, clans)
+            cpu += time.process_time() - start
+        print(f"{name:>22}: {cpu / args.repeat * 1000:8.3f} ms CPU per response")
+
+if __name__ == "__main__":
+    main()
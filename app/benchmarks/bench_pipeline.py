@@ -0,0 +1,208 @@
+"""End-to-end benchmark of the clan crawl and the poll pipeline against the local mock API.
+The mock, the crawl and the poll cycles each run in their own process, so CPU time and
+peak memory are those of the bot alone.
+Run from the app directory: python -m benchmarks.bench_pipeline [--clans 1000 20000 200000]"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import socket
+import tempfile
+import time
+
+from benchmarks.mock_api import serve, base_url
+from utils.const import CLAN_URLS, CLAN_DETAILS_URLS, LOGGER_NAME, NO_OF_CONSUMERS, MAX_NUM_OF_IDS
+from utils.enums import Region
+from utils.keys import KeyPool
+from utils.http import ApiClient
+
+REGION = Region.EU
+
+def free_port() -> int:
+    """Port nobody listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    """Block until the mock accepts connections"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Mock API did not start on port {port}")
+
+def use_mock(port: int) -> None:
+    """Point the API urls of the benchmarked region at the mock"""
+    CLAN_URLS[REGION.value] = f"{base_url(port)}/wot/clans/list/"
+    CLAN_DETAILS_URLS[REGION.value] = f"{base_url(port)}/wot/clans/info/"
+
+def usage() -> tuple[float, float]:
+    """CPU seconds used so far and peak resident memory in MiB"""
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KiB on Linux
+    return usage_self.ru_utime + usage_self.ru_stime, usage_self.ru_maxrss / 1024
+
+def result(scenario: str, seconds: float, requests: int, cpu: float, **extra) -> dict:
+    """Row of the report"""
+    _, peak = usage()
+    return dict(scenario=scenario, seconds=seconds, requests=requests,
+                rps=requests / seconds if seconds else 0.0, cpu=cpu, peak=peak, **extra)
+
+async def run_crawl(filename: str, keys: KeyPool, workers: int) -> None:
+    """get_clans.py without its command line"""
+    import get_clans # pylint: disable=import-outside-toplevel
+    async with ApiClient() as client:
+        total_pages = await get_clans.start(client, keys, region=REGION)
+        await get_clans.crawl(total_pages, filename, client, keys, "sqlite", workers=workers, region=REGION)
+
+def crawl_scenario(port: int, filename: str, args: argparse.Namespace, results) -> None:
+    """Crawl every clan of the mock into filename"""
+    logging.getLogger(LOGGER_NAME).setLevel(args.log_level.upper())
+    use_mock(port)
+    keys = KeyPool(["benchmark"], rate=args.rate, max_rate=args.rate)
+    cpu_start, _ = usage()
+    start = time.perf_counter()
+    asyncio.run(run_crawl(filename, keys, args.workers))
+    seconds = time.perf_counter() - start
+    cpu, _ = usage()
+    results.put(result("crawl", seconds, sum(x.requests for x in keys.keys), cpu - cpu_start))
+
+async def drain(queue: asyncio.Queue, found: list) -> None:
+    """Stand-in for the discord delivery, counts recruits"""
+    while True:
+        found.append(await queue.get())
+        queue.task_done()
+
+async def run_cycles(filename: str, keys: KeyPool, args: argparse.Namespace) -> dict:
+    """Poll every clan of filename the way main.py does.
+    Only the cycles are measured, loading the state is reported separately"""
+    # main.py is imported here, the crawl process does not need the discord dependencies
+    import main # pylint: disable=import-outside-toplevel
+    from utils.fetcher import fetcher # pylint: disable=import-outside-toplevel
+    from utils.inflight import InFlight # pylint: disable=import-outside-toplevel
+    from utils.parser import parse_response # pylint: disable=import-outside-toplevel
+    from utils.state import CompactClans # pylint: disable=import-outside-toplevel
+    from utils.stats import PollStats # pylint: disable=import-outside-toplevel
+    from utils.storage import read_file # pylint: disable=import-outside-toplevel
+
+    load_start = time.perf_counter()
+    if args.state == "compact":
+        clans = CompactClans(filename).load()
+    else:
+        clans = read_file(filename, "sqlite")
+    load = time.perf_counter() - load_start
+    queues = {REGION: asyncio.Queue()}
+    response_queue, recruit_queue = asyncio.Queue(maxsize=2 * NO_OF_CONSUMERS), asyncio.Queue()
+    inflight = InFlight(2 * NO_OF_CONSUMERS * MAX_NUM_OF_IDS)
+    stats, changed, found = PollStats(), set(), []
+    client = await ApiClient().open()
+    tasks = [asyncio.create_task(drain(recruit_queue, found))]
+    for _ in range(NO_OF_CONSUMERS):
+        tasks.append(asyncio.create_task(fetcher(queues[REGION], response_queue, keys, client)))
+        tasks.append(asyncio.create_task(
+            parse_response(response_queue, recruit_queue, clans, changed, queues, stats,
+                           inflight=inflight)))
+
+    cycles, cpu_start = [], usage()[0]
+    for _ in range(args.cycles):
+        start = time.perf_counter()
+        await main.get_members(clans, 0, queues, {REGION: keys}, args.poll_mode, inflight=inflight)
+        # two-phase polling queues member requests while summaries are parsed
+        for _ in range(2):
+            await queues[REGION].join()
+            await response_queue.join()
+        await recruit_queue.join()
+        cycles.append(time.perf_counter() - start)
+    cpu = usage()[0] - cpu_start
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await client.close()
+    return result("poll", sum(cycles), sum(x.requests for x in keys.keys), cpu,
+                  load=load, cycle=sum(cycles) / len(cycles), recruits=len(found))
+
+def poll_scenario(port: int, filename: str, args: argparse.Namespace, results) -> None:
+    """Load the crawled clans and run poll cycles against the mock"""
+    logging.getLogger(LOGGER_NAME).setLevel(args.log_level.upper())
+    use_mock(port)
+    keys = KeyPool(["benchmark"], rate=args.rate, max_rate=args.rate)
+    results.put(asyncio.run(run_cycles(filename, keys, args)))
+
+def run_process(context, target, *args) -> dict:
+    """Run a scenario in a fresh process and return its result"""
+    results = context.Queue()
+    process = context.Process(target=target, args=args + (results,))
+    process.start()
+    while True:
+        try:
+            row = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"{target.__name__} exited with code {process.exitcode}") from None
+    process.join()
+    return row
+
+def benchmark(no_clans: int, args: argparse.Namespace) -> list[dict]:
+    """Crawl and poll a mock holding no_clans clans"""
+    context = multiprocessing.get_context("spawn")
+    port = free_port()
+    mock_args = argparse.Namespace(clans=no_clans, clan_size=args.clan_size, churn=args.churn,
+                                   disband=args.disband, throttle=args.throttle, timeout=args.timeout,
+                                   latency=args.latency, seed=0, host="127.0.0.1", port=port)
+    mock = context.Process(target=serve, args=(mock_args,), daemon=True)
+    mock.start()
+    try:
+        wait_for_port(port)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "clans.db")
+            rows = [run_process(context, crawl_scenario, port, filename, args)]
+            rows.append(run_process(context, poll_scenario, port, filename, args))
+    finally:
+        mock.terminate()
+        mock.join()
+    return rows
+
+def get_arguments() -> argparse.Namespace:
+    """Parse arguments"""
+    parser = argparse.ArgumentParser(prog="bench_pipeline")
+    parser.add_argument("--clans", type=int, nargs="+", default=[1000, 20000, 200000])
+    parser.add_argument("--clan-size", type=int, default=30, help="Mean number of members per clan")
+    parser.add_argument("--churn", type=float, default=0.05)
+    parser.add_argument("--disband", type=float, default=0.001)
+    parser.add_argument("--throttle", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--timeout", type=float, default=0.0, help="Share of requests answered with 504")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock adds to every response")
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="Requests per second the bot may send, the real API allows 20 per ID")
+    parser.add_argument("--workers", type=int, default=4, help="Crawl requests in flight")
+    parser.add_argument("--cycles", type=int, default=3, help="Poll cycles to run")
+    parser.add_argument("--poll-mode", choices=["full", "two-phase"], default="full")
+    parser.add_argument("--state", choices=["full", "compact"], default="full")
+    parser.add_argument("--log-level", default="error")
+    return parser.parse_args()
+
+def main():
+    """main"""
+    args = get_arguments()
+    print(f"{'clans':>7} {'scenario':>8} {'seconds':>8} {'requests':>8} {'req/s':>8} "
+          f"{'cpu s':>7} {'cpu %':>6} {'peak MiB':>8}  notes")
+    for no_clans in args.clans:
+        for row in benchmark(no_clans, args):
+            notes = ""
+            if row["scenario"] == "poll":
+                notes = f"{row['cycle']:.2f} s per cycle, state loaded in {row['load']:.1f} s, " \
+                        f"{row['recruits']} recruits"
+            print(f"{no_clans:>7} {row['scenario']:>8} {row['seconds']:>8.2f} {row['requests']:>8} "
+                  f"{row['rps']:>8.1f} {row['cpu']:>7.2f} {100 * row['cpu'] / row['seconds']:>6.0f} "
+                  f"{row['peak']:>8.1f}  {notes}", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Local stand-in for the clans/list, clans/info and account/info endpoints of the Wargaming API.
+Clans are synthetic, their rosters change while they are polled and a share of
+the requests is answered with 429 or 504 like the real API does under load.
+Run from the app directory: python -m benchmarks.mock_api [--clans 20000] [--port 8765]"""
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+from utils.const import MEMBER_FIELDS
+
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    from json import dumps as _dumps
+    def json_dumps(obj) -> bytes:
+        """json.dumps returning bytes like orjson"""
+        return _dumps(obj).encode()
+
+FIRST_ACCOUNT_ID = 500000000
+FIRST_NEW_ACCOUNT_ID = 900000000
+PAGE_SIZE = 100
+MAX_CLAN_SIZE = 100
+ALL_FIELDS = frozenset(MEMBER_FIELDS.split(","))
+
+def clan_size(clan_id: int, mean: int) -> int:
+    """Deterministic clan size between 1 and twice the mean, never above the API maximum"""
+    return 1 + (clan_id * 7919) % min(2 * mean - 1, MAX_CLAN_SIZE)
+
+def initial_roster(clan_id: int, mean: int) -> list[int]:
+    """Account ids of a clan before anything changed"""
+    first = FIRST_ACCOUNT_ID + clan_id * MAX_CLAN_SIZE
+    return list(range(first, first + clan_size(clan_id, mean)))
+
+class MockClan:
+    """Mutable state of a synthetic clan"""
+    __slots__ = ("roster", "updated_at", "is_clan_disbanded")
+
+    def __init__(self, roster: list[int], updated_at: int):
+        self.roster = roster
+        self.updated_at = updated_at
+        self.is_clan_disbanded = False
+
+class MockApi:
+    """Serves a fixed set of clans.
+    Every time a clan is returned by clans/info one member leaves and a new one joins with
+    chance churn, and the clan disbands with chance disband. Clans are created on first
+    use so large lists cost nothing until they are polled"""
+    def __init__(self,
+                 clans: int,
+                 mean_size: int = 30,
+                 churn: float = 0.05,
+                 disband: float = 0.001,
+                 throttle: float = 0.0,
+                 timeout: float = 0.0,
+                 latency: float = 0.0,
+                 seed: int = 0):
+        self.clans = clans
+        self.mean_size = mean_size
+        self.churn = churn
+        self.disband = disband
+        self.throttle = throttle
+        self.timeout = timeout
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.state = {}
+        self.next_account_id = FIRST_NEW_ACCOUNT_ID
+        self.requests = 0
+        self.errors = 0
+        self.created = int(time.time())
+
+    def clan(self, clan_id: int) -> MockClan:
+        """State of a clan after the changes of this poll"""
+        clan = self.state.get(clan_id)
+        if clan is None:
+            clan = self.state[clan_id] = MockClan(initial_roster(clan_id, self.mean_size), self.created)
+        if clan.is_clan_disbanded:
+            return clan
+        if self.random.random() < self.disband:
+            clan.is_clan_disbanded = True
+            clan.updated_at = int(time.time())
+        elif clan.roster and self.random.random() < self.churn:
+            clan.roster.pop(self.random.randrange(len(clan.roster)))
+            clan.roster.append(self.next_account_id)
+            self.next_account_id += 1
+            clan.updated_at = int(time.time())
+        return clan
+
+    def entry(self, clan_id: int, fields: set[str]) -> dict:
+        """clans/info entry limited to the requested fields"""
+        clan = self.clan(clan_id)
+        entry = {
+            "clan_id": clan_id,
+            "name": f"Clan {clan_id}",
+            "tag": f"C{clan_id}",
+            "old_name": "",
+            "description": f"Synthetic clan number {clan_id}",
+            "is_clan_disbanded": clan.is_clan_disbanded,
+            "members_count": len(clan.roster),
+            "updated_at": clan.updated_at,
+        }
+        if "members" in fields:
+            entry["members"] = [{"account_id": x, "account_name": f"player{x}", "role": "private"}
+                                for x in clan.roster]
+        return {k: v for k, v in entry.items() if k in fields}
+
+    def error(self) -> web.Response | None:
+        """Injected failure for this request, if any"""
+        draw = self.random.random()
+        if draw < self.throttle:
+            return web.Response(status=429)
+        if draw < self.throttle + self.timeout:
+            return web.Response(status=504)
+        return None
+
+    async def respond(self, request: web.Request, build) -> web.Response:
+        """Common handling of every endpoint"""
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not request.query.get("application_id"):
+            return self.json({"status": "error", "error": {"code": 402, "message": "APPLICATION_ID_NOT_SPECIFIED"}})
+        if (error := self.error()) is not None:
+            self.errors += 1
+            return error
+        return self.json(build(request.query))
+
+    @staticmethod
+    def json(data: dict) -> web.Response:
+        """Encoded response"""
+        return web.Response(body=json_dumps(data), content_type="application/json")
+
+    def clans_list(self, query) -> dict:
+        """Page of clan ids"""
+        page_no = int(query.get("page_no", 1))
+        limit = int(query.get("limit", PAGE_SIZE))
+        first = (page_no - 1) * limit + 1
+        data = [{"clan_id": x} for x in range(first, min(first + limit, self.clans + 1))]
+        if "members_count" in query.get("fields", ""):
+            for entry in data:
+                entry["members_count"] = clan_size(entry["clan_id"], self.mean_size)
+        return {"status": "ok", "meta": {"count": len(data), "page_total": len(data),
+                                         "total": self.clans, "limit": limit, "page": page_no},
+                "data": data}
+
+    def clans_info(self, query) -> dict:
+        """Details of up to 100 clans, unknown ids map to null like the real API"""
+        fields = set(query["fields"].split(",")) if query.get("fields") else ALL_FIELDS
+        data = {}
+        for clan_id in query.get("clan_id", "").split(","):
+            clan_id = int(clan_id)
+            if not 1 <= clan_id <= self.clans:
+                data[str(clan_id)] = None
+                continue
+            data[str(clan_id)] = self.entry(clan_id, fields)
+        return {"status": "ok", "meta": {"count": len(data)}, "data": data}
+
+    def accounts_info(self, query) -> dict:
+        """Deterministic statistics of up to 100 players"""
+        data = {}
+        for account_id in query.get("account_id", "").split(","):
+            seed = int(account_id) * 2654435761 % 1000003
+            battles = seed % 40000
+            data[account_id] = {"last_battle_time": self.created - seed % (90 * 24 * 60 * 60),
+                                "global_rating": seed % 12000,
+                                "statistics": {"all": {"battles": battles,
+                                                       "wins": battles * (40 + seed % 25) // 100}}}
+        return {"status": "ok", "meta": {"count": len(data)}, "data": data}
+
+    async def list_handler(self, request: web.Request) -> web.Response:
+        """GET /wot/clans/list/"""
+        return await self.respond(request, self.clans_list)
+
+    async def info_handler(self, request: web.Request) -> web.Response:
+        """GET /wot/clans/info/"""
+        return await self.respond(request, self.clans_info)
+
+    async def account_handler(self, request: web.Request) -> web.Response:
+        """GET /wot/account/info/"""
+        return await self.respond(request, self.accounts_info)
+
+    async def stats_handler(self, _request: web.Request) -> web.Response:
+        """GET /stats, requests served so far"""
+        return self.json({"requests": self.requests, "errors": self.errors})
+
+    def app(self) -> web.Application:
+        """aiohttp application serving the API paths of the real hosts"""
+        app = web.Application()
+        app.router.add_get("/wot/clans/list/", self.list_handler)
+        app.router.add_get("/wot/clans/info/", self.info_handler)
+        app.router.add_get("/wot/account/info/", self.account_handler)
+        app.router.add_get("/stats", self.stats_handler)
+        return app
+
+def base_url(port: int, host: str = "127.0.0.1") -> str:
+    """Url standing in for https://api.worldoftanks.eu"""
+    return f"http://{host}:{port}"
+
+def get_arguments() -> argparse.Namespace:
+    """Parse arguments"""
+    parser = argparse.ArgumentParser(prog="mock_api",
+                                     description="Local stand-in for the Wargaming clan endpoints")
+    parser.add_argument("--clans", type=int, default=20000, help="Number of synthetic clans")
+    parser.add_argument("--clan-size", type=int, default=30, help="Mean number of members per clan")
+    parser.add_argument("--churn", type=float, default=0.05,
+                        help="Chance a returned clan lost a member and gained a new one")
+    parser.add_argument("--disband", type=float, default=0.001,
+                        help="Chance a returned clan disbanded")
+    parser.add_argument("--throttle", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--timeout", type=float, default=0.0, help="Share of requests answered with 504")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    return parser.parse_args()
+
+def serve(args: argparse.Namespace) -> None:
+    """Run the mock until interrupted"""
+    api = MockApi(args.clans, args.clan_size, args.churn, args.disband,
+                  args.throttle, args.timeout, args.latency, args.seed)
+    web.run_app(api.app(), host=args.host, port=args.port, access_log=None, print=None)
+
+def main():
+    """main"""
+    args = get_arguments()
+    print(f"Serving {args.clans} clans on {base_url(args.port, args.host)}")
+    serve(args)
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,16 @@ import sys
 import string
 import argparse
 import os
+import time
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
 
 from fast_langdetect import detect, detect_multilingual, detect_language
 from utils.const import LOGGER_NAME
-from utils.storage import store_file, read_file
+from utils.storage import store_file, read_file, iter_rows, read_rows, parse_rows, BACKENDS
+from utils.language_cache import LanguageCache, description_key, model_version
 
 logger = logging.getLogger(LOGGER_NAME)
 
@@ -18,6 +23,14 @@ console_foramt = logging.Formatter(fmt="%(asctime)s - [%(levelname)s] - %(messag
 console_handler.setFormatter(console_foramt)
 logger.addHandler(console_handler)
 
+# removes everything outside string.printable in one pass,
+# same result as filter(lambda x: x in string.printable, line)
+NON_PRINTABLE = dict.fromkeys(x for x in range(128) if chr(x) not in string.printable)
+# languages with a score per line, scores of other languages count as 0
+TOP_K = 5
+# model loaded once by every worker process
+_model = None
+
 def threshold_range(arg):
     """ Type function for argparse - a float within some predefined bounds """
     try:
@@ -48,6 +61,11 @@ def get_arguments() -> argparse.Namespace:
                         type=str,
                         help="File clan data will be stored in",
                         required=True)
+    parser.add_argument('--storage',
+                        choices=BACKENDS,
+                        help="Storage backend of the data files. \
+                            auto picks sqlite for .db/.sqlite files and csv otherwise",
+                        default=os.environ.get("STORAGE_BACKEND", "auto"))
     parser.add_argument("--language",
                         type=str,
                         choices=['af', 'als', 'am', 'an', 'ar', 'arz', 'as', 'ast', 'av', 'az', 'azb', 'ba', 'bar', 'bcl', 'be', 'bg', 'bh', 'bn', 'bo', 'bpy', 'br', 'bs', 'bxr', 'ca', 'cbk', 'ce', 'ceb', 'ckb', 'co', 'cs', 'cv', 'cy', 'da', 'de', 'diq', 'dsb', 'dty', 'dv', 'el', 'eml', 'en', 'eo', 'es', 'et', 'eu', 'fa', 'fi', 'fr', 'frr', 'fy', 'ga', 'gd', 'gl', 'gn', 'gom', 'gu', 'gv', 'he', 'hi', 'hif', 'hr', 'hsb', 'ht', 'hu', 'hy', 'ia', 'id', 'ie', 'ilo', 'io', 'is', 'it', 'ja', 'jbo', 'jv', 'ka', 'kk', 'km', 'kn', 'ko', 'krc', 'ku', 'kv', 'kw', 'ky', 'la', 'lb', 'lez', 'li', 'lmo', 'lo', 'lrc', 'lt', 'lv', 'mai', 'mg', 'mhr', 'min', 'mk', 'ml', 'mn', 'mr', 'mrj', 'ms', 'mt', 'mwl', 'my', 'myv', 'mzn', 'nah', 'nap', 'nds', 'ne', 'new', 'nl', 'nn', 'no', 'oc', 'or', 'os', 'pa', 'pam', 'pfl', 'pl', 'pms', 'pnb', 'ps', 'pt', 'qu', 'rm', 'ro', 'ru', 'rue', 'sa', 'sah', 'sc', 'scn', 'sco', 'sd', 'sh', 'si', 'sk', 'sl', 'so', 'sq', 'sr', 'su', 'sv', 'sw', 'ta', 'te', 'tg', 'th', 'tk', 'tl', 'tr', 'tt', 'tyv', 'ug', 'uk', 'ur', 'uz', 'vec', 'vep', 'vi', 'vls', 'vo', 'wa', 'war', 'wuu', 'xal', 'xmf', 'yi', 'yo', 'yue', 'zh'],
@@ -55,8 +73,25 @@ def get_arguments() -> argparse.Namespace:
                         help="Determine if the decsription is this language")
     parser.add_argument("--threshold",
                         type=threshold_range,
-                        default=0.2,
-                        help="The average score has to be higher then this to be considered valid")
+                        default=0,
+                        help="Besides winning most lines, the average score of the language has to be \
+                            higher then this. 0 only requires the majority of lines")
+    parser.add_argument("--cache-file",
+                        type=str,
+                        default=os.environ.get("LANGUAGE_CACHE", "language_cache.db"),
+                        help="Database with earlier classifications, only new or edited descriptions are classified")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Number of processes classifying descriptions")
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=1000,
+                        help="Number of clans sent to a worker at once")
+    parser.add_argument("--model",
+                        type=str,
+                        help="Path of a fastText language identification model, \
+                            the model of fast_langdetect is used when omitted")
     args = parser.parse_args()
 
     logger.setLevel(args.log_level.upper())
@@ -95,30 +130,146 @@ def main():
 
     store_file(dutch_clans, args.outfile)
 
-def main2():
-    """main2"""
-    args = get_arguments()
-    clans = read_file(args.input_file)
-    dutch_clans = []
-    for clan in clans.values():
-        lines = clan.description.splitlines()
-        languages = []
+def normalize(line: str) -> str:
+    """Drop characters the model was not meant to see"""
+    return line.encode("ascii", "ignore").decode("ascii").translate(NON_PRINTABLE)
+
+def description_lines(description: str) -> list[str]:
+    """Non empty lines of a description, normalized"""
+    return [normalize(x) for x in description.splitlines() if len(x) > 0 and not x.isspace()]
+
+def init_worker(model_path: str = None) -> None:
+    """Load the fastText model once per worker process"""
+    global _model # pylint: disable=global-statement
+    if model_path:
+        import fasttext # pylint: disable=import-outside-toplevel
+        _model = fasttext.load_model(model_path)
+    else:
+        # fast_langdetect has no public way to get its model, only to classify one text at a
+        # time. get_model_loaded is internal, fast-langdetect is pinned in requirements.txt
+        # for it, check this import when upgrading or pass --model
+        from fast_langdetect.ft_detect.infer import get_model_loaded # pylint: disable=import-outside-toplevel
+        _model = get_model_loaded(low_memory=False)
+
+def label(raw: str) -> str:
+    """language code of a fastText label"""
+    return raw.replace("__label__", "").upper()
+
+def predict(lines: list[str]) -> list[list[tuple[str, float]]]:
+    """Most likely languages with their score for every line, a single batched call into fastText.
+    Falls back to line by line when the batch is rejected, so one bad line only loses itself"""
+    try:
+        labels, probabilities = _model.predict(lines, k=TOP_K)
+        return [[(label(x), float(p)) for x, p in zip(line_labels, line_probabilities)]
+                for line_labels, line_probabilities in zip(labels, probabilities)]
+    except ValueError:
+        predictions = []
         for line in lines:
-            if len(line) == 0 or line.isspace():
-                continue
-            line = ''.join(filter(lambda x: x in string.printable, line))
             try:
-                language = detect_language(line, low_memory=False)
-                languages.append(language)
+                labels, probabilities = _model.predict(line, k=TOP_K)
+                predictions.append([(label(x), float(p)) for x, p in zip(labels, probabilities)])
             except ValueError as ve:
-                logger.error("Error parsing description: %s, Error:%s", clan.description, ve.args)
-        if len(languages) > 0:
-            counter = Counter(languages)
-            if counter.most_common(1)[0][0] == args.language.upper():
-                logger.info("Potential %s Clan: %s",
-                            args.language, clan.name)
-                dutch_clans.append(clan)
-    store_file(dutch_clans, args.outfile)
+                logger.error("Error parsing description line: %s, Error:%s", line, ve.args)
+                predictions.append([])
+        return predictions
+
+def score_chunk(chunk: list[tuple[str, list[str]]]) -> list[tuple[str, dict, dict]]:
+    """Classify the normalized lines of every description in the chunk.
+    Returns per description how many lines every language won
+    and the average score of every language over all lines"""
+    lines, owners = [], []
+    for key, description in chunk:
+        lines.extend(description)
+        owners.extend([key] * len(description))
+    votes = {key: {} for key, _ in chunk}
+    scores = {key: {} for key, _ in chunk}
+    for key, prediction in zip(owners, predict(lines) if lines else []):
+        if prediction:
+            votes[key][prediction[0][0]] = votes[key].get(prediction[0][0], 0) + 1
+        for language, score in prediction:
+            scores[key][language] = scores[key].get(language, 0.0) + score
+    results = []
+    for key, description in chunk:
+        average = {x: round(y / len(description), 4) for x, y in scores[key].items()}
+        results.append((key, votes[key], average))
+    return results
+
+def is_language(votes: dict, scores: dict, language: str, threshold: float) -> bool:
+    """Language won most lines of the description and scored above the threshold on average"""
+    if not votes:
+        return False
+    # ties go to the language found first, like Counter.most_common
+    majority = Counter(votes).most_common(1)[0][0]
+    return majority == language.upper() and scores.get(majority, 0.0) > threshold
+
+def classify(descriptions: Iterable[tuple[str, list[str]]],
+             workers: int,
+             chunk_size: int,
+             model_path: str = None) -> Iterator[tuple[str, dict, dict]]:
+    """Stream (key, normalized lines) pairs through a pool of worker processes.
+    Only a few chunks per worker are in flight, results come back in input order"""
+    descriptions = iter(descriptions)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(model_path,)) as pool:
+        pending = []
+        while True:
+            while len(pending) < workers * 2:
+                chunk = list(islice(descriptions, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.submit(score_chunk, chunk))
+            if not pending:
+                return
+            yield from pending.pop(0).result()
+
+def main2():
+    """main2"""
+    args = get_arguments()
+    if not os.path.exists(args.input_file):
+        logger.error("Data-file error: %s does not exist", args.input_file)
+        return
+    model = model_version(args.model)
+    cache = LanguageCache(args.cache_file)
+    # rows are streamed, only the clans in the chosen language are read completely.
+    # identical descriptions are classified once
+    logger.info("Parsing data file: %s", args.input_file)
+    run_start = time.perf_counter()
+    clan_keys, descriptions, total_clans = {}, {}, 0
+    for row in iter_rows(args.input_file, args.storage):
+        # clans without a description count as processed
+        total_clans += 1
+        lines = description_lines(row["description"] or "")
+        if lines:
+            key = description_key(lines, model)
+            clan_keys[str(row["clan_id"])] = key
+            descriptions.setdefault(key, lines)
+    results = cache.get_many(descriptions.keys())
+    missing = [(x, y) for x, y in descriptions.items() if x not in results]
+    logger.info("%d distinct descriptions, %d cached, classifying %d",
+                len(descriptions), len(results), len(missing))
+
+    start = time.perf_counter()
+    try:
+        for done, (key, votes, scores) in enumerate(classify(missing, args.workers,
+                                                             args.chunk_size, args.model), 1):
+            results[key] = (votes, scores)
+            cache.put(key, votes, scores)
+            if done % (args.chunk_size * 10) == 0:
+                logger.info("Classified %d of %d descriptions, %.0f per second",
+                            done, len(missing), done / (time.perf_counter() - start))
+    finally:
+        cache.close()
+    logger.info("Classified %d descriptions in %.1f seconds", len(missing), time.perf_counter() - start)
+
+    matches = [x for x, key in clan_keys.items() if is_language(*results[key], args.language, args.threshold)]
+    dutch_clans = parse_rows(read_rows(args.input_file, matches, args.storage))
+    for clan_id, clan in dutch_clans.items():
+        logger.info("Potential %s Clan: %s, average score: %f", args.language, clan.name,
+                    results[clan_keys[clan_id]][1].get(args.language.upper(), 0.0))
+    store_file(dutch_clans, args.output_file, args.storage)
+    elapsed = time.perf_counter() - run_start
+    logger.info("Processed %d clans in %.1f seconds, %.0f clans per second",
+                total_clans, elapsed, total_clans / elapsed if elapsed else 0)
 
 if __name__ == "__main__":
     try:
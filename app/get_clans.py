@@ -5,14 +5,18 @@ import os
 import logging
 import argparse
 import sys
+import json
 
 import aiohttp
-from aiolimiter import AsyncLimiter
 
 from pydantic import ValidationError
-from utils.const import LOGGER_NAME, CLAN_URL, CLAN_DETAILS_URL
-from utils.fetcher import fetch
-from utils.storage import store_file
+from utils.const import LOGGER_NAME, CLAN_URLS, CLAN_DETAILS_URLS, MEMBER_FIELDS, DEFAULT_REGION
+from utils.enums import Region
+from utils.fetcher import fetch, fetch_batch
+from utils.batching import plan_batches
+from utils.keys import KeyPool
+from utils.http import ApiClient, ClientConfig, add_client_arguments
+from utils.storage import append_file, storage_backend, trim_partial_line, truncate_file, BACKENDS
 from models import Clan
 
 logger = logging.getLogger(LOGGER_NAME)
@@ -23,7 +27,7 @@ console_foramt = logging.Formatter(fmt="%(asctime)s - [%(levelname)s] - %(messag
 console_handler.setFormatter(console_foramt)
 logger.addHandler(console_handler)
 
-def parse_clan_response(responses: list[dict]) -> dict[Clan]:
+def parse_clan_response(responses: list[dict], region: Region = Region.EU) -> dict[Clan]:
     """Parse repsonses and create clan list"""
     clans = {}
     for response in responses:
@@ -36,7 +40,7 @@ def parse_clan_response(responses: list[dict]) -> dict[Clan]:
         data = response.get('data')
         for clan_id, entry in data.items():
             try:
-                clan = Clan(**entry)
+                clan = Clan(**dict(entry, region=region))
                 clans[clan_id] = clan
             except ValidationError as ve:
                 logger.error("Error parsing data: %s with error %s",
@@ -45,65 +49,221 @@ def parse_clan_response(responses: list[dict]) -> dict[Clan]:
                 logger.error("Error while parsing member data. Error: %s", te.args)
     return clans
 
-async def get_all_desciptions(app_id: str, clan_ids: list[str]) -> dict[Clan]:
-    """Retrieve all clan details"""
-    limiter = AsyncLimiter(max_rate=4, time_period=1)
-    tasks = []
-    responses = []
-    async with aiohttp.ClientSession() as session:
-        for clan_group in clan_ids:
-            params = {
-                'application_id': app_id,
-                'clan_id': clan_group,
-                "fields": "name,clan_id,tag,is_clan_disbanded,old_name,members_count,description,members"
-            }
-            task = fetch(CLAN_DETAILS_URL, params=params, session=session, limiter=limiter)
-            tasks.append(task)
-        logger.debug("Created all fetch tasks for Clan Data")
-        responses = await asyncio.gather(*tasks)
-    return parse_clan_response(responses)
-
-def parse_id_response(response: dict) -> str:
-    """Parse clan id response"""
+def parse_id_response(response: dict) -> dict[str, int] | None:
+    """Parse clan id response, returns the member count of every clan id, None when the query failed"""
     logger.debug("Parsing Response: %s", response)
     if len(response) == 0:
         logger.error("Empty response")
-        return ''
+        return None
     if response.get('status') != 'ok':
         logger.error("query failed: %s", response.get('error'))
-        return ''
+        return None
     clan_ids = response.get('data')
-    list_of_ids = [str(clan_id.get('clan_id')) for clan_id in clan_ids]
-    string_of_ids = ",".join(list_of_ids)
-    return string_of_ids
+    return {str(clan_id.get('clan_id')): clan_id.get('members_count') or 0 for clan_id in clan_ids}
 
 async def get_id(params: dict,
-                session: aiohttp.ClientSession,
-                limiter: AsyncLimiter):
+                client: ApiClient,
+                keys: KeyPool,
+                region: Region = Region.EU):
     """pipe response into parser"""
-    response = await fetch(CLAN_URL, params=params, session=session, limiter=limiter)
+    response = await fetch(CLAN_URLS[region.value], params=params, client=client, keys=keys)
     logger.debug("Parsing page %d", params.get('page_no'))
     return parse_id_response(response)
 
-async def get_all_ids(app_id: str, total_pages: int = 1, search: str = None) -> list[str]:
-    """Retrieve all clan IDs"""
-    limiter = AsyncLimiter(max_rate=3, time_period=1)
-    tasks = []
-    async with aiohttp.ClientSession() as session:
-        for page_no in range(1, total_pages+1, 1):
+class CrawlCheckpoint:
+    """Append only log of crawled pages and stored ID batches, used to resume a crawl"""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.pages = {}
+        self.members = {}
+        self.stored = set()
+        self.failed = set()
+        # size of a csv output file when the last page was stored, None when unknown
+        self.output_size = None
+
+    def load(self) -> None:
+        """Read progress of a previous run"""
+        try:
+            with open(self.filename, "r", encoding="utf-8") as file:
+                self.output_size = 0
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line can be cut off when the previous run was killed
+                        continue
+                    if "ids" in entry:
+                        self.pages[entry["page"]] = entry["ids"]
+                        # missing in checkpoints of older versions
+                        self.members[entry["page"]] = entry.get("members")
+                    else:
+                        self.stored.add(entry["page"])
+                        # missing in checkpoints of older versions and of sqlite crawls
+                        self.output_size = entry.get("size")
+            logger.info("Resuming crawl, %d pages retrieved and %d batches stored",
+                        len(self.pages), len(self.stored))
+        except FileNotFoundError:
+            logger.info("No checkpoint found at %s, starting a new crawl", self.filename)
+
+    def reset(self) -> None:
+        """Forget progress of previous runs"""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def _append(self, entry: dict) -> None:
+        with open(self.filename, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    def page_done(self, page_no: int, clan_ids: str, members: list[int]) -> None:
+        """Record the clan ids found on a page and their member counts"""
+        self.pages[page_no] = clan_ids
+        self.members[page_no] = members
+        self._append({"page": page_no, "ids": clan_ids, "members": members})
+
+    def batch_done(self, page_no: int, output_size: int = None) -> None:
+        """Record that the clans of a page are written to the output file,
+        and the size of a csv output file after they were written"""
+        self.stored.add(page_no)
+        self.output_size = output_size
+        self._append({"page": page_no, "size": output_size})
+
+    def missing_pages(self) -> int:
+        """Pages that failed in this run or whose clans were not stored,
+        pages without clans count as done"""
+        return len(self.failed - self.pages.keys()) + len(self.pages.keys() - self.stored)
+
+    def pending_batches(self) -> list[tuple[int, str, list[int]]]:
+        """ID batches that were retrieved but not yet stored"""
+        return [(page_no, ids, self.members.get(page_no)) for page_no, ids in self.pages.items()
+                if page_no not in self.stored]
+
+async def page_worker(search: str,
+                      pages: asyncio.Queue,
+                      batches: asyncio.Queue,
+                      client: ApiClient,
+                      keys: KeyPool,
+                      checkpoint: CrawlCheckpoint,
+                      region: Region) -> None:
+    """Turn page numbers into batches of clan ids"""
+    while True:
+        page_no = await pages.get()
+        try:
             params = {
-                'application_id': app_id,
                 'page_no': page_no,
-                "fields": "clan_id"
+                "fields": "clan_id,members_count"
             }
             if search:
                 params['search'] = search
-            task = get_id(params=params, session=session, limiter=limiter)
-            tasks.append(task)
-        logger.debug("Created all fetch tasks for ID's")
-        parsed_responses = await asyncio.gather( *tasks)
-        parsed_responses = list(filter(None, parsed_responses))
-    return parsed_responses
+            members = await get_id(params=params, client=client, keys=keys, region=region)
+            if members is None:
+                checkpoint.failed.add(page_no)
+            elif members:
+                clan_ids = ",".join(members)
+                checkpoint.page_done(page_no, clan_ids, list(members.values()))
+                await batches.put((page_no, clan_ids, list(members.values())))
+        except aiohttp.ClientError as ce:
+            checkpoint.failed.add(page_no)
+            logger.error("Error fetching page %d. msg: %s", page_no, ce)
+        finally:
+            pages.task_done()
+
+async def detail_worker(batches: asyncio.Queue,
+                        client: ApiClient,
+                        keys: KeyPool,
+                        checkpoint: CrawlCheckpoint,
+                        filename: str,
+                        backend: str,
+                        region: Region) -> None:
+    """Retrieve clan details for a batch of ids and write them to the output file.
+    The ids of a page are requested in batches balanced on their member counts.
+    A page is only written once all of its clans were retrieved, otherwise it is
+    logged and stays pending for --resume"""
+    while True:
+        page_no, clan_ids, members = await batches.get()
+        try:
+            responses, failed = [], []
+            for batch in plan_batches(clan_ids.split(","), members):
+                params = {
+                    'clan_id': ",".join(batch),
+                    "fields": MEMBER_FIELDS
+                }
+                for part, response, _ in await fetch_batch(CLAN_DETAILS_URLS[region.value], params, client, keys):
+                    if response.get('status') == 'ok':
+                        responses.append(response)
+                    else:
+                        failed.append(part['clan_id'])
+            if failed:
+                logger.error("Failed to retrieve clan details of page %d, clans %s",
+                             page_no, ",".join(failed))
+                continue
+            clans = parse_clan_response(responses, region)
+            if append_file(clans, filename, backend):
+                # nothing is awaited in between, the size only holds complete pages
+                csv_file = storage_backend(filename, backend) == "csv"
+                checkpoint.batch_done(page_no, os.path.getsize(filename) if csv_file else None)
+                logger.debug("Stored %d clans of page %d, API rate %.1f requests per second",
+                             len(clans), page_no, keys.rate)
+        except aiohttp.ClientError as ce:
+            logger.error("Error fetching clan details of page %d. msg: %s", page_no, ce)
+        finally:
+            batches.task_done()
+
+async def crawl(total_pages: int,
+                filename: str,
+                client: ApiClient,
+                keys: KeyPool,
+                backend: str = "auto",
+                search: str = None,
+                resume: bool = False,
+                workers: int = 4,
+                region: Region = Region.EU) -> None:
+    """Crawl all pages with a bounded number of requests in flight,
+    clans are written to disk as soon as their details arrive"""
+    if total_pages == 0:
+        # never drop the progress or output of an earlier crawl because the first request failed
+        logger.error("No clan pages found, not crawling")
+        return
+    checkpoint = CrawlCheckpoint(f"{filename}.checkpoint")
+    if resume:
+        checkpoint.load()
+        if storage_backend(filename, backend) == "csv":
+            # rows of pages that were not checkpointed are written again
+            if checkpoint.output_size is not None:
+                truncate_file(filename, checkpoint.output_size)
+            else:
+                trim_partial_line(filename)
+    else:
+        checkpoint.reset()
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    pages = asyncio.Queue()
+    batches = asyncio.Queue(maxsize=workers * 2)
+    tasks = []
+    for _ in range(workers):
+        tasks.append(asyncio.create_task(
+            page_worker(search, pages, batches, client, keys, checkpoint, region)))
+        tasks.append(asyncio.create_task(
+            detail_worker(batches, client, keys, checkpoint, filename, backend, region)))
+    for batch in checkpoint.pending_batches():
+        await batches.put(batch)
+    for page_no in range(1, total_pages+1, 1):
+        if page_no not in checkpoint.pages:
+            pages.put_nowait(page_no)
+    await pages.join()
+    await batches.join()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    missing = checkpoint.missing_pages()
+    if missing > 0:
+        logger.error("%d pages could not be retrieved, rerun with --resume to retry them", missing)
+    else:
+        checkpoint.reset()
+        logger.info("Stored all clans in %s", filename)
+    logger.info("Finished crawl at an API rate of %.1f requests per second", keys.rate)
+    keys.report()
 
 def determine_no_pagers(response: dict) -> int:
     """Calculate amount of total pages"""
@@ -122,23 +282,19 @@ def determine_no_pagers(response: dict) -> int:
     logger.debug("Found %d pages", total_pages)
     return total_pages
 
-async def start(app_id: str, search: str = None) -> int:
+async def start(client: ApiClient, keys: KeyPool, search: str = None, region: Region = Region.EU) -> int:
     """First request to determine amount of pages"""
     params = {
-            'application_id': app_id,
             'page_no': 1,
             "fields": "clan_id"
         }
     if search:
         params['search'] = search
-    limiter = AsyncLimiter(max_rate=4, time_period=1)
     try:
-        async with aiohttp.ClientSession() as session:
-            response =  await fetch(CLAN_URL, params, session, limiter) # get the ball rolling
-            return determine_no_pagers(response)
-    except (aiohttp.ServerDisconnectedError, aiohttp.ClientResponseError,
-            aiohttp.ClientConnectorError ) as se:
-        logger.error("Error fetching member Data. msg: %s", se.message)
+        response =  await fetch(CLAN_URLS[region.value], params, client, keys) # get the ball rolling
+        return determine_no_pagers(response)
+    except aiohttp.ClientError as se:
+        logger.error("Error fetching member Data. msg: %s", se)
         return 0
 
 def get_arguments() -> argparse.Namespace:
@@ -153,13 +309,37 @@ def get_arguments() -> argparse.Namespace:
     parser.add_argument("--application-id",
                         dest="id",
                         type=str,
-                        help=" id of your Wargaming application",
+                        help="id of your Wargaming application, several comma separated IDs \
+                            share the crawl",
                         default=os.environ.get("APPLICATION_ID"))
+    parser.add_argument("--region",
+                        choices=[x.value for x in Region],
+                        help="Realm to retrieve clans from",
+                        default=os.environ.get("REGION", DEFAULT_REGION))
     parser.add_argument("--output-file",
                         dest="file",
                         type=str,
                         help="File clan data will be stored in",
                         required=True)
+    parser.add_argument('--storage',
+                        choices=BACKENDS,
+                        help="Storage backend of the data files. \
+                            auto picks sqlite for .db/.sqlite files and csv otherwise",
+                        default=os.environ.get("STORAGE_BACKEND", "auto"))
+    parser.add_argument('--rate-limit',
+                        type=int, help="Starting rate limit in Requests per Second of the Wargames API per application ID.",
+                        default=os.environ.get("WOT_RATE_LIMIT", 4))
+    parser.add_argument('--max-rate-limit',
+                        type=int, help="Highest rate in Requests per Second the script will try per application ID.",
+                        default=os.environ.get("WOT_MAX_RATE_LIMIT", 20))
+    add_client_arguments(parser)
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Continue an interrupted crawl instead of starting over")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=4,
+                        help="Number of pages and clan detail batches in flight")
     parser.add_argument("--search",
                         type=str,
                         help="If supplied look for clan names with this string in the name.\
@@ -195,29 +375,31 @@ def main() -> None:
     for s in signals:
         loop.add_signal_handler(
             s, lambda s=s: asyncio.create_task(shutdown(s, loop)))
+    client = None
     try:
         logger.info("Starting App")
 
-        total_pages = loop.run_until_complete(start(args.id, args.search))
-
-        grouped_clan_ids = loop.run_until_complete(
-                                    get_all_ids(
-                                        args.id,
-                                        total_pages=total_pages,
-                                        search=args.search)
-                                    )
-        logger.info("Got all clan ids")
-        # with open("clan_ids.txt", "a", encoding="utf-8") as file:
-        #     for line in grouped_clan_ids:
-        #         file.write(line +'\n')
-        # grouped_clan_ids = []
-        # with open("clan_ids.txt", "r",encoding="utf-8") as file:
-        #     grouped_clan_ids = file.readlines()
-
-        clans = loop.run_until_complete(get_all_desciptions(args.id, grouped_clan_ids))
-
-        store_file(clans, args.file)
+        keys = KeyPool.from_string(args.id, rate=args.rate_limit, max_rate=args.max_rate_limit)
+        region = Region(args.region)
+        # both phases share the connections to the API host
+        client = loop.run_until_complete(ApiClient(ClientConfig.from_args(args)).open())
+        total_pages = loop.run_until_complete(start(client, keys, args.search, region))
+        if total_pages == 0:
+            logger.error("Cannot determine the number of clan pages, %s is left unchanged", args.file)
+            return
+
+        loop.run_until_complete(crawl(total_pages,
+                                      args.file,
+                                      client,
+                                      keys,
+                                      backend=args.storage,
+                                      search=args.search,
+                                      resume=args.resume,
+                                      workers=args.workers,
+                                      region=region))
     finally:
+        if client is not None:
+            loop.run_until_complete(client.close())
         loop.close()
         logger.info("Successfully shutdown get Clans script.")
         sys.exit(0)
@@ -6,25 +6,40 @@ import logging
 import os
 import sys
 import argparse
+import time
 
 import asyncio
-import aiohttp
-from aiolimiter import AsyncLimiter
 
 from discord_logging.handler import DiscordHandler
-from discord import Webhook, Embed
 
 from sane_argument_parser import SaneArgumentParser
 from models import Clan
 
-from utils.const import (CLAN_DETAILS_URL,
-                         MEMBER_DETAILS_URL,
+from utils.const import (CLAN_DETAILS_URLS,
                          LOGGER_NAME,
                          NO_OF_CONSUMERS,
-                         MAX_NUM_OF_IDS)
-from utils.storage import read_file, store_file
-from utils.fetcher import fetcher
+                         MAX_NUM_OF_IDS,
+                         MEMBER_FIELDS,
+                         SUMMARY_FIELDS)
+from utils.enums import RequestType, Region
+from utils.storage import read_file, store_file, store_changes, storage_backend, BACKENDS
+from utils.fetcher import fetcher, Request
+from utils.keys import KeyPool
+from utils.http import ApiClient, ClientConfig, add_client_arguments
 from utils.parser import parse_response
+from utils.delivery import recruit_members
+from utils.outbox import Outbox
+from utils.dedup import RecruitCache, SharedRecruitCache
+from utils.stats import PollStats
+from utils.scheduler import PollScheduler
+from utils.state import CompactClans
+from utils.shard import select_shard
+from utils import metrics
+from utils.profiling import PROFILER, ROUTES, span
+from utils.inflight import InFlight
+from utils.batching import plan_batches
+from utils.reload import ClanReloader
+from utils.enrich import RecruitEnricher, RecruitRules, StatsCache
 
 logger = logging.getLogger(LOGGER_NAME)
 
@@ -34,57 +49,148 @@ console_foramt = logging.Formatter(fmt="%(asctime)s - [%(levelname)s] - %(messag
 console_handler.setFormatter(console_foramt)
 logger.addHandler(console_handler)
 
-async def get_members(app_id: str,
-                      clans: dict[Clan],
+def member_request(clan_ids: list[str], poll_mode: str, region: Region = Region.EU) -> Request:
+    """Build the request for a group of clans of the same region.
+    In two-phase mode only cheap fields are requested, the parser
+    requests full member lists for clans where those changed"""
+    request_type, fields = RequestType.MEMBER, MEMBER_FIELDS
+    if poll_mode == "two-phase":
+        request_type, fields = RequestType.SUMMARY, SUMMARY_FIELDS
+    params = {
+        'clan_id': ",".join(clan_ids),
+        "fields": fields
+    }
+    return Request(request_type, CLAN_DETAILS_URLS[region.value], params, region, time.perf_counter())
+
+def by_region(clans: dict[Clan], clan_ids: list[str]) -> dict[Region, list[str]]:
+    """Group clan ids by the realm they are polled from"""
+    groups = {}
+    for clan_id in clan_ids:
+        groups.setdefault(clans[clan_id].region, []).append(clan_id)
+    return groups
+
+def plan_requests(clans: dict[Clan], clan_ids: list[str], poll_mode: str = "full") -> list[list[str]]:
+    """Batches of clans of the same region.
+    Full member lists are balanced on the stored member counts, summaries are small
+    enough to always send the maximum number of ids"""
+    if poll_mode == "two-phase":
+        return plan_batches(clan_ids)
+    return plan_batches(clan_ids, [clans[x].members_count for x in clan_ids])
+
+def api_rates(keys: dict[Region, KeyPool]) -> str:
+    """Current API rate of every region"""
+    return ", ".join(f"{region.name} {pool.rate:.1f}" for region, pool in keys.items())
+
+async def time_cycle(queues: dict[Region, asyncio.Queue], start: float) -> None:
+    """Record how long it took to fetch every request of a poll cycle"""
+    for queue in queues.values():
+        await queue.join()
+    metrics.POLL_CYCLE.observe(time.monotonic() - start)
+
+def cycle_estimate(clans: dict[Clan], keys: dict[Region, KeyPool], poll_mode: str = "full") -> float:
+    """Seconds a poll cycle takes at least at the current API rates"""
+    return max((len(plan_requests(clans, clan_ids, poll_mode)) / keys[region].rate
+                for region, clan_ids in by_region(clans, list(clans.keys())).items()), default=0.0)
+
+async def get_members(clans: dict[Clan],
                       update_interval: int,
-                      queue: asyncio.Queue) -> None:
-    """produce requests for member data"""
+                      queues: dict[Region, asyncio.Queue],
+                      keys: dict[Region, KeyPool] = None,
+                      poll_mode: str = "full",
+                      stats: PollStats = None,
+                      inflight: InFlight = None) -> None:
+    """produce requests for member data, every region has its own queue.
+    With inflight the producer waits for room in the pipeline and skips clans
+    that are still in flight from the previous cycle"""
+    if keys and update_interval and (estimate := cycle_estimate(clans, keys, poll_mode)) > update_interval:
+        logger.warning("Polling %d clans takes at least %.0f seconds at the current API rate, "
+                       "longer than the update interval of %d seconds",
+                       len(clans), estimate, update_interval)
     while True:
-        logger.info("Fetching Member Data")
-        # group clan ids in single request to reduce traffic
-        clan_id_list = list(clans.keys())
-        n = MAX_NUM_OF_IDS
-        clan_groups = [clan_id_list[i:i+n] for i in range(0, len(clan_id_list),n)]
-        for group in clan_groups:
-            clan_ids = ",".join(group)
-            logger.debug("Fetching Members Data for clans: %s", clan_ids)
-            params = {
-                'application_id': app_id,
-                'clan_id': clan_ids,
-                "fields": "name,clan_id,tag,is_clan_disbanded,old_name,members_count,description,members"
-            }
-            await queue.put((CLAN_DETAILS_URL, params))
+        if stats:
+            stats.report()
+            stats.reset()
+        if keys:
+            logger.info("Fetching Member Data, API rate %s requests per second", api_rates(keys))
+        else:
+            logger.info("Fetching Member Data")
+        start = time.monotonic()
+        cycle = inflight.start_cycle() if inflight is not None else None
+        # group clan ids in single request to reduce traffic.
+        # planned up front, a reload can remove clans while requests are queued
+        plans = [(region, plan_requests(clans, clan_id_list, poll_mode))
+                 for region, clan_id_list in by_region(clans, list(clans.keys())).items()]
+        for region, groups in plans:
+            for group in groups:
+                if inflight is not None:
+                    with span("admit", region=str(region), clans=len(group)):
+                        group = await inflight.admit(group, cycle, region)
+                if group:
+                    logger.debug("Fetching Members Data for clans: %s", group)
+                    await queues[region].put(member_request(group, poll_mode, region))
+        if inflight is not None:
+            inflight.end_cycle(cycle)
+        else:
+            asyncio.create_task(time_cycle(queues, start))
         if update_interval == 0:
             break
-        await asyncio.sleep(update_interval)
+        await asyncio.sleep(max(update_interval - (time.monotonic() - start), 0))
 
-async def recruit_members(queue: asyncio.Queue, url: str) -> None:
-    """Send recruit data to discord channel.
-    Webhooks are rate limited to 30 message per minute
-    according to stackoverflow"""
-    limiter = AsyncLimiter(30, 60)
+async def schedule_members(scheduler: PollScheduler,
+                           queues: dict[Region, asyncio.Queue],
+                           keys: dict[Region, KeyPool] = None,
+                           poll_mode: str = "full",
+                           stats: PollStats = None,
+                           inflight: InFlight = None) -> None:
+    """produce requests for clans as they become due.
+    Batches are sent at a steady pace instead of all at once every update interval"""
+    last_report = time.monotonic()
     while True:
-        reason, member, clan = await queue.get()
-        try:
-            if url:
-                logger.info("Sending %s information to discord", member.account_name)
-                async with limiter:
-                    async with aiohttp.ClientSession() as session:
-                        webhook = Webhook.from_url(url, session=session)
-                        stat_url = f"{MEMBER_DETAILS_URL}{member.account_name}-{member.account_id}/"
-                        message = "Member Found:\n"\
-                                f"Name: {member.account_name}\n"\
-                                f"ID: {member.account_id}\n"\
-                                f"Reason: {reason}\n"\
-                                f"From Clan: {clan.name} {clan.clan_id}\n"\
-                                f"stats: {stat_url}"
-                        embed = Embed(title=message,color=2196944)
-                        await webhook.send(embed=embed, username='WOT_BOT')
-        except (aiohttp.ServerDisconnectedError, aiohttp.ClientResponseError,
-                aiohttp.ClientConnectorError ) as se:
-            logger.error("Error sending Data to discord recruit channel. Error: %s",se.message)
-        finally:
-            queue.task_done()
+        if time.monotonic() - last_report >= scheduler.update_interval:
+            last_report = time.monotonic()
+            if stats:
+                stats.report()
+                stats.reset()
+            scheduler.report()
+            if keys:
+                logger.info("API rate %s requests per second", api_rates(keys))
+                for pool in keys.values():
+                    pool.report()
+        group = scheduler.next_batch(MAX_NUM_OF_IDS)
+        plans = [(region, plan_requests(scheduler.clans, region_group, poll_mode))
+                 for region, region_group in by_region(scheduler.clans, group).items()]
+        for region, batches in plans:
+            for batch in batches:
+                if inflight is not None:
+                    with span("admit", region=str(region), clans=len(batch)):
+                        batch = await inflight.admit(batch, region=region)
+                if batch:
+                    logger.debug("Fetching Members Data for clans: %s", batch)
+                    await queues[region].put(member_request(batch, poll_mode, region))
+        await asyncio.sleep(scheduler.tick(MAX_NUM_OF_IDS))
+
+async def checkpoint(clans: dict[Clan],
+                     changed: set[str],
+                     filename: str,
+                     backend: str,
+                     interval: int,
+                     outbox: Outbox = None,
+                     dedup: RecruitCache = None) -> None:
+    """Periodically persist clans that changed since the previous checkpoint.
+    The outbox is flushed first, a stored roster never hides recruits that were not yet logged"""
+    while True:
+        await asyncio.sleep(interval)
+        pending = set(changed)
+        changed.difference_update(pending)
+        if outbox:
+            outbox.flush()
+        if dedup is not None:
+            await dedup.checkpoint()
+        if isinstance(clans, CompactClans):
+            clans.flush()
+        elif not await store_changes(clans, pending, filename, backend):
+            # keep them, the next checkpoint tries again
+            changed.update(pending)
 
 async def shutdown(sig: signal.signal, loop: asyncio.BaseEventLoop) -> None:
     """Cleanup tasks tied to the service's shutdown."""
@@ -114,9 +220,116 @@ def get_arguments() -> argparse.Namespace:
                         type=str,
                         help="csv file containing clan names",
                         default=os.environ.get("DATAFILE"))
+    parser.add_argument('--storage',
+                        choices=BACKENDS,
+                        help="Storage backend of the data file. \
+                            auto picks sqlite for .db/.sqlite files and csv otherwise",
+                        default=os.environ.get("STORAGE_BACKEND", "auto"))
+    parser.add_argument('--state',
+                        choices=['full', 'compact'],
+                        help="full keeps every clan with its members in memory. \
+                            compact only keeps member ids and reads names from the data file \
+                            when they are needed, requires the sqlite backend",
+                        default=os.environ.get("STATE", "full"))
+    parser.add_argument('--checkpoint-interval',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Seconds between saving changed clans to the data file. 0 disables checkpoints",
+                        default=os.environ.get("CHECKPOINT_INTERVAL", 60))
+    parser.add_argument('--reload-interval',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Seconds between checks whether the data file changed, \
+                            added and removed clans are picked up without a restart. \
+                            SIGHUP reloads right away. 0 only reloads on SIGHUP. \
+                            Defaults to 60 with the sqlite backend and 0 with csv, needs sqlite \
+                            while checkpoints are enabled",
+                        required=False,
+                        default=os.environ.get("RELOAD_INTERVAL") or None)
+    parser.add_argument('--outbox-file',
+                        type=str,
+                        help="File recruits are kept in until they are posted on discord. \
+                            Defaults to the data file with an .outbox extension",
+                        default=os.environ.get("OUTBOX_FILE", ""))
+    parser.add_argument('--dedup-ttl',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Seconds during which a player is not posted again after a notification. \
+                            0 disables deduplication",
+                        default=os.environ.get("DEDUP_TTL", 24*60*60))
+    parser.add_argument('--dedup-size',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Maximum number of players remembered for deduplication",
+                        default=os.environ.get("DEDUP_SIZE", 100000))
+    parser.add_argument('--dedup-file',
+                        type=str,
+                        help="File recently notified players are stored in. \
+                            Defaults to the data file with a .dedup extension",
+                        default=os.environ.get("DEDUP_FILE", ""))
     parser.add_argument('--rate-limit',
-                        type=int, help="Rate limit in Requests per Second of the Wargames API.",
+                        type=int, help="Starting rate limit in Requests per Second of the Wargames API per application ID. \
+                            The rate is raised while requests succeed and lowered when the API throttles",
                         default=os.environ.get("WOT_RATE_LIMIT", 10))
+    parser.add_argument('--max-rate-limit',
+                        type=int, help="Highest rate in Requests per Second the bot will try per application ID.",
+                        default=os.environ.get("WOT_MAX_RATE_LIMIT", 20))
+    parser.add_argument('--max-in-flight',
+                        type=SaneArgumentParser.positive_int,
+                        help="Clans per region that are queued, fetched or parsed at the same time. \
+                            New requests wait until there is room, clans still in flight are skipped by the next cycle",
+                        default=os.environ.get("MAX_IN_FLIGHT", 2 * NO_OF_CONSUMERS * MAX_NUM_OF_IDS))
+    add_client_arguments(parser)
+    parser.add_argument('--poll-mode',
+                        choices=['full', 'two-phase'],
+                        help="full requests every member list each update. \
+                            two-phase first requests member counts and update times \
+                            and only fetches member lists of clans that changed",
+                        default=os.environ.get("POLL_MODE", "full"))
+    parser.add_argument('--schedule',
+                        choices=['fixed', 'adaptive'],
+                        help="fixed polls every clan once per update interval. \
+                            adaptive polls clans where members leave often more frequently \
+                            and spreads requests evenly over the update interval",
+                        default=os.environ.get("SCHEDULE", "fixed"))
+    parser.add_argument('--shard-index',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Which part of the data file this instance polls, counting from 0",
+                        default=os.environ.get("SHARD_INDEX", 0))
+    parser.add_argument('--shard-count',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Number of bot instances sharing the data file. \
+                            Every instance polls and stores its own share of the clans",
+                        default=os.environ.get("SHARD_COUNT", 1))
+    parser.add_argument('--metrics-port',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Serve pipeline metrics in the Prometheus format on this port. 0 disables metrics",
+                        default=os.environ.get("METRICS_PORT", 0))
+    parser.add_argument('--profile-seconds',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Seconds the profiler runs after SIGUSR1 or a POST to /profile on the metrics port",
+                        default=os.environ.get("PROFILE_SECONDS", 60))
+    parser.add_argument('--profile-dir',
+                        type=str,
+                        help="Directory profiles are written to. Defaults to the directory of the data file",
+                        default=os.environ.get("PROFILE_DIR", ""))
+    parser.add_argument('--player-stats',
+                        choices=['on', 'off'],
+                        help="Look up battles, win rate and last battle of recruits before they are posted. \
+                            Uses requests of the application IDs, turned on by the recruit rules",
+                        default=os.environ.get("PLAYER_STATS", "off"))
+    parser.add_argument('--stats-cache-ttl',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Seconds looked up player statistics are reused",
+                        default=os.environ.get("STATS_CACHE_TTL", 6*60*60))
+    parser.add_argument('--min-battles',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Only post recruits with at least this many battles. 0 disables the rule",
+                        default=os.environ.get("MIN_BATTLES", 0))
+    parser.add_argument('--min-win-rate',
+                        type=float,
+                        help="Only post recruits with at least this win rate in percent. 0 disables the rule",
+                        default=os.environ.get("MIN_WIN_RATE", 0))
+    parser.add_argument('--max-inactive-days',
+                        type=SaneArgumentParser.non_negative_int,
+                        help="Only post recruits that played a battle within this many days. 0 disables the rule",
+                        default=os.environ.get("MAX_INACTIVE_DAYS", 0))
     parser.add_argument('--discord-logging-url',
                         type=str,
                         help="Discord channel to send logging data to",
@@ -128,7 +341,8 @@ def get_arguments() -> argparse.Namespace:
     parser.add_argument("--application-id",
                         dest="id",
                         type=str,
-                        help=" id of your Wargaming application",
+                        help="id of your Wargaming application. \
+                            Pass several comma separated IDs to spread requests over their quotas",
                         default=os.environ.get("APPLICATION_ID"))
     parser.add_argument("--update-interval",
                         type=SaneArgumentParser.non_negative_int,
@@ -136,6 +350,24 @@ def get_arguments() -> argparse.Namespace:
                             Time interval is in seconds, default is once an hour",
                         default=os.environ.get("UPDATE_INTERVAL", 60*60))
     args = parser.parse_args()
+    if not args.id:
+        parser.error("--application-id is required")
+    if args.state == "compact" and storage_backend(args.data_file, args.storage) != "sqlite":
+        parser.error("--state compact requires the sqlite storage backend")
+    if args.shard_count > 1 and storage_backend(args.data_file, args.storage) != "sqlite":
+        parser.error("--shard-count requires the sqlite storage backend")
+    csv_checkpoints = storage_backend(args.data_file, args.storage) == "csv" and args.checkpoint_interval > 0
+    if args.reload_interval is None:
+        args.reload_interval = 0 if csv_checkpoints else 60
+    elif args.reload_interval > 0 and csv_checkpoints:
+        # every checkpoint rewrites a csv file from memory, which undoes the edits before
+        # they are reloaded and changes the file the watcher looks at
+        parser.error("--reload-interval requires the sqlite storage backend or --checkpoint-interval 0")
+    if args.shard_index >= max(args.shard_count, 1):
+        parser.error("--shard-index must be lower than --shard-count")
+    if args.min_battles or args.min_win_rate or args.max_inactive_days:
+        # the rules can't be checked without statistics
+        args.player_stats = "on"
 
     logger.setLevel(args.log_level.upper())
     if args.discord_logging_url:
@@ -154,38 +386,131 @@ def get_arguments() -> argparse.Namespace:
 def main() -> None:
     """main"""
     args = get_arguments()
-    clans = read_file(args.data_file)
+    if args.state == "compact":
+        clans = CompactClans(args.data_file).load()
+    else:
+        clans = read_file(args.data_file, args.storage)
+    select_shard(clans, args.shard_index, args.shard_count)
+    changed = set()
+    recruit_queue = None
+    dedup = None
+    client = None
     loop = asyncio.get_event_loop()
 
-    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+    signals = (signal.SIGTERM, signal.SIGINT)
     for s in signals:
         loop.add_signal_handler(
             s, lambda s=s: asyncio.create_task(shutdown(s, loop)))
+    PROFILER.directory = args.profile_dir or os.path.dirname(os.path.abspath(args.data_file))
+    if args.profile_seconds > 0:
+        loop.add_signal_handler(signal.SIGUSR1, PROFILER.start, args.profile_seconds)
 
     try:
         logger.info("Starting App")
-        limiter = AsyncLimiter(max_rate=args.rate_limit, time_period=1)
-
-        request_queue = asyncio.Queue()
-        response_queue = asyncio.Queue()
-        recruit_queue = asyncio.Queue()
+        # realms are polled concurrently, each with its own limiters and connections
+        regions = sorted({x.region for x in clans.values()}, key=lambda x: x.value) or [Region.EU]
+        keys = {x: KeyPool.from_string(args.id, rate=args.rate_limit, max_rate=args.max_rate_limit)
+                for x in regions}
+        # request queues are bounded by inflight, a size limit could deadlock
+        # parsers that queue member requests for changed clans
+        request_queues = {x: asyncio.Queue() for x in regions}
+        response_queue = asyncio.Queue(maxsize=2 * NO_OF_CONSUMERS)
+        # the limit applies to every region on its own
+        inflight = InFlight(args.max_in_flight, args.update_interval)
+        sharded = args.shard_count > 1
+        # every instance needs its own outbox, the dedup cache is shared
+        shard_suffix = f".shard{args.shard_index}" if sharded else ""
+        recruit_queue = Outbox(args.outbox_file or f"{args.data_file}{shard_suffix}.outbox")
+        loop.create_task(recruit_queue.run())
+        stats = PollStats()
+        if args.dedup_ttl > 0 and sharded:
+            dedup = SharedRecruitCache(args.dedup_file or f"{args.data_file}.dedup.db",
+                                       args.dedup_ttl, args.dedup_size)
+        elif args.dedup_ttl > 0:
+            dedup = RecruitCache(args.dedup_file or f"{args.data_file}.dedup",
+                                 args.dedup_ttl, args.dedup_size)
+        scheduler = None
+        if args.schedule == "adaptive" and args.update_interval > 0:
+            scheduler = PollScheduler(clans, args.update_interval)
+        # every fetcher of every region shares one connection pool
+        client = loop.run_until_complete(ApiClient(ClientConfig.from_args(args)).open())
+        for region in regions:
+            for _ in range(NO_OF_CONSUMERS):
+                loop.create_task(fetcher(request_queues[region], response_queue, keys[region], client))
         for _ in range(NO_OF_CONSUMERS):
-            loop.create_task(fetcher(request_queue,response_queue, limiter))
             loop.create_task(parse_response(response_queue,
                                             recruit_queue,
-                                            clans))
+                                            clans,
+                                            changed,
+                                            request_queues,
+                                            stats,
+                                            scheduler,
+                                            dedup,
+                                            inflight))
+
+        if scheduler:
+            loop.create_task(schedule_members(scheduler,
+                                              request_queues,
+                                              keys,
+                                              args.poll_mode,
+                                              stats,
+                                              inflight))
+        else:
+            loop.create_task(get_members(clans,
+                                         args.update_interval,
+                                         request_queues,
+                                         keys,
+                                         args.poll_mode,
+                                         stats,
+                                         inflight))
+
+        enricher = None
+        if args.player_stats == "on":
+            rules = RecruitRules(args.min_battles, args.min_win_rate, args.max_inactive_days)
+            enricher = RecruitEnricher(client, keys, rules, StatsCache(args.stats_cache_ttl))
+        loop.create_task(recruit_members(recruit_queue, args.discord_recruit_url, enricher=enricher))
+
+        if args.metrics_port > 0:
+            for region, queue in request_queues.items():
+                metrics.QUEUE_DEPTH.labels(f"request_{region}").set_function(queue.qsize)
+            metrics.QUEUE_DEPTH.labels("response").set_function(response_queue.qsize)
+            metrics.QUEUE_DEPTH.labels("recruit").set_function(recruit_queue.qsize)
+            metrics.QUEUE_DEPTH.labels("in_flight_clans").set_function(lambda: len(inflight))
+            routes = ROUTES if args.profile_seconds > 0 else []
+            loop.run_until_complete(metrics.serve_metrics(args.metrics_port, routes=routes))
 
-        loop.create_task(get_members(args.id, clans,
-                                     args.update_interval,
-                                     request_queue))
+        # SIGHUP reloads the watched clans instead of stopping the bot
+        reloader = ClanReloader(clans, args.data_file, args.storage, request_queues,
+                                scheduler, inflight, args.shard_index, args.shard_count)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(reloader.reload("SIGHUP")))
+        if args.reload_interval > 0:
+            loop.create_task(reloader.watch(args.reload_interval))
 
-        loop.create_task(recruit_members(recruit_queue, args.discord_recruit_url))
+        if args.checkpoint_interval > 0:
+            loop.create_task(checkpoint(clans, changed, args.data_file,
+                                        args.storage, args.checkpoint_interval,
+                                        recruit_queue, dedup))
 
         loop.run_forever()
     finally:
+        PROFILER.stop()
+        if client is not None:
+            loop.run_until_complete(client.close())
         loop.close()
         logger.info("Successfully shutdown the WOT recruitment Bot.")
-        store_file(clans, args.data_file)
+        if recruit_queue is not None:
+            recruit_queue.close()
+        if dedup is not None:
+            dedup.save()
+        sqlite = storage_backend(args.data_file, args.storage) == "sqlite"
+        if isinstance(clans, CompactClans):
+            clans.flush()
+            clans = {}
+        elif sqlite:
+            # rows that did not change since the last checkpoint are already stored
+            clans = {x: clans[x] for x in changed if x in clans}
+        if clans:
+            store_file(clans, args.data_file, args.storage, update_only=sqlite)
         sys.exit(0)
 
 if __name__ == "__main__":
@@ -1,7 +1,27 @@
 """merge multiple csv file containing clan data"""
 import argparse
+import csv
+import heapq
+import json
+import logging
+import os
+import sys
+import tempfile
+from typing import Iterable, Iterator
 
-from utils.storage import read_file, store_file
+from pydantic import ValidationError
+
+from models import Clan
+from utils.const import LOGGER_NAME
+from utils.storage import read_file, store_file, iter_rows, store_rows, clan_row, HEADERS, BACKENDS
+
+logger = logging.getLogger(LOGGER_NAME)
+
+console_handler = logging.StreamHandler(sys.stdout)
+console_foramt = logging.Formatter(fmt="%(asctime)s - [%(levelname)s] - %(message)s",
+                                   datefmt='%Y/%m/%d %H:%M:%S')
+console_handler.setFormatter(console_foramt)
+logger.addHandler(console_handler)
 
 def get_arguments() -> argparse.Namespace:
     ''' Parse arguments from CLI or if none supplied get them from Environmental variables'''
@@ -19,18 +39,112 @@ def get_arguments() -> argparse.Namespace:
                         type=str,
                         help="File clan data will be stored in",
                         required=True)
+    parser.add_argument('--storage',
+                        choices=BACKENDS,
+                        help="Storage backend of the data files. \
+                            auto picks sqlite for .db/.sqlite files and csv otherwise",
+                        default=os.environ.get("STORAGE_BACKEND", "auto"))
+    parser.add_argument('--streaming',
+                        action="store_true",
+                        help="Merge raw rows instead of loading every file into memory. \
+                            Rows are sorted on disk once the memory budget is exceeded")
+    parser.add_argument('--memory-budget',
+                        type=int,
+                        default=512,
+                        help="Megabytes of rows kept in memory by the streaming merge")
+    parser.add_argument('--validate',
+                        action="store_true",
+                        help="Validate merged rows with the Clan model in streaming mode, \
+                            invalid rows are dropped")
     args = parser.parse_args()
     return args
 
+def row_size(row: dict) -> int:
+    """Rough number of bytes a row takes in memory"""
+    return sum(len(x) for x in row.values() if isinstance(x, str)) + 64 * len(row)
+
+def clan_key(row: dict) -> int | None:
+    """Numeric clan id of a raw row"""
+    try:
+        return int(row.get("clan_id"))
+    except (TypeError, ValueError):
+        logger.error("Skipping row without a valid clan_id: %s", row)
+        return None
+
+def write_run(rows: dict[int, dict], directory: str, run_no: int) -> str:
+    """Write rows sorted on clan id to a temporary csv file"""
+    filename = os.path.join(directory, f"run{run_no}.csv")
+    with open(filename, "w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=HEADERS)
+        for key in sorted(rows):
+            writer.writerow(rows[key])
+    return filename
+
+def read_run(filename: str, run_no: int) -> Iterator[tuple[int, int, dict]]:
+    """Rows of a run with their sort key, later runs sort after earlier ones"""
+    with open(filename, "r", encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file, fieldnames=HEADERS):
+            yield int(row["clan_id"]), run_no, row
+
+def merge_rows(filenames: list[str], backend: str, budget: int, directory: str) -> Iterator[dict]:
+    """Last row of every clan id over all files, later files win.
+    Rows are collected in memory, when they exceed the budget they are written
+    to a sorted run on disk and the runs are merged at the end"""
+    rows, size, runs = {}, 0, []
+    for filename in filenames:
+        logger.info("Reading %s", filename)
+        for row in iter_rows(filename, backend):
+            key = clan_key(row)
+            if key is None:
+                continue
+            rows[key] = row
+            size += row_size(row)
+            if size > budget:
+                runs.append(write_run(rows, directory, len(runs)))
+                logger.info("Memory budget reached, wrote run %d with %d clans", len(runs), len(rows))
+                rows, size = {}, 0
+    if not runs:
+        yield from rows.values()
+        return
+    if rows:
+        runs.append(write_run(rows, directory, len(runs)))
+    merged = heapq.merge(*(read_run(x, i) for i, x in enumerate(runs)))
+    previous = None
+    for key, _, row in merged:
+        # equal clan ids arrive in run order, only the last one is kept
+        if previous is not None and previous[0] != key:
+            yield previous[1]
+        previous = (key, row)
+    if previous is not None:
+        yield previous[1]
+
+def validated(rows: Iterable[dict]) -> Iterator[dict]:
+    """Rows that pass the Clan model, in the form store_file writes them"""
+    for row in rows:
+        try:
+            clan = Clan(**dict(row, members=json.loads(row.get("members") or "[]")))
+            yield clan_row(clan)
+        except (ValidationError, ValueError) as ve:
+            logger.error("Parsing Error. Line: %s, Error: %s", row, ve)
+
 def main():
+    """main"""
     args = get_arguments()
 
+    if args.streaming:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(args.output_file))) as directory:
+            rows = merge_rows(args.input_files, args.storage, args.memory_budget * 2**20, directory)
+            if args.validate:
+                rows = validated(rows)
+            store_rows(rows, args.output_file, args.storage)
+        return
+
     merged_files = {}
     for file in args.input_files:
-        clans = read_file(file)
+        clans = read_file(file, args.storage)
         merged_files |= clans
 
-    store_file(merged_files, args.output_file)
+    store_file(merged_files, args.output_file, args.storage)
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,6 @@
 """init"""
-from models.clan import Clan
+from models.clan import Clan, text_fields_hash
 from models.member import Member
-__all__ = ["Clan", "Member"]
+from models.player import PlayerStats
+from models.recruit import Recruit
+__all__ = ["Clan", "Member", "PlayerStats", "Recruit", "text_fields_hash"]
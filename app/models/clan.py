@@ -1,8 +1,17 @@
 """model storing Clan data"""
 import json
-from pydantic import BaseModel, field_serializer
+from functools import cached_property
+
+import numpy as np
+from pydantic import BaseModel, field_serializer, field_validator
 
 from models.member import Member
+from utils.diff import roster_array
+from utils.enums import Region
+
+def text_fields_hash(name: str, tag: str, old_name: str, description: str) -> int:
+    """hash of the free text fields, used to detect changes without keeping the text around"""
+    return hash((name, tag, old_name, description))
 
 class Clan(BaseModel, str_strip_whitespace=True):
     """class that store clan data"""
@@ -14,9 +23,40 @@ class Clan(BaseModel, str_strip_whitespace=True):
     members_count: int = 0
     description: str = ''
     members: list[Member] = []
+    updated_at: int = 0
+    region: Region = Region.EU
+
+    @field_validator("updated_at", mode="before")
+    @classmethod
+    def validate_updated_at(cls, value):
+        """missing timestamps are stored as 0"""
+        return value or 0
+
+    @field_validator("region", mode="before")
+    @classmethod
+    def validate_region(cls, value):
+        """files written before regions existed only contain EU clans"""
+        if not value:
+            return Region.EU
+        return value.lower() if isinstance(value, str) else value
+
+    @field_serializer("region")
+    def serialize_region(self, region, _info):
+        """store the region as its name"""
+        return region.value
 
     @field_serializer("members")
     def serialize_members(self, members, _info):
         """serialize members list to json"""
         json_members = [x.model_dump() for x in members]
         return json.dumps(json_members)
+
+    @cached_property
+    def roster(self) -> np.ndarray:
+        """sorted account ids of all members"""
+        return roster_array(x.account_id for x in self.members)
+
+    @cached_property
+    def fields_hash(self) -> int:
+        """hash of name, tag, old_name and description"""
+        return text_fields_hash(self.name, self.tag, self.old_name, self.description)
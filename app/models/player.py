@@ -0,0 +1,23 @@
+"""model storing the statistics of a player"""
+from pydantic import BaseModel
+
+class PlayerStats(BaseModel):
+    """account statistics as returned by the account info endpoint"""
+    battles: int = 0
+    wins: int = 0
+    last_battle_time: int = 0
+    global_rating: int = 0
+
+    @classmethod
+    def from_api(cls, entry: dict) -> "PlayerStats":
+        """Flatten an account info entry"""
+        totals = (entry.get("statistics") or {}).get("all") or {}
+        return cls(battles=totals.get("battles") or 0,
+                   wins=totals.get("wins") or 0,
+                   last_battle_time=entry.get("last_battle_time") or 0,
+                   global_rating=entry.get("global_rating") or 0)
+
+    @property
+    def win_rate(self) -> float:
+        """percentage of battles won"""
+        return 100 * self.wins / self.battles if self.battles else 0.0
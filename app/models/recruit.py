@@ -0,0 +1,17 @@
+"""model storing a potential recruit"""
+import time
+from pydantic import BaseModel, Field
+
+from models.member import Member
+from models.player import PlayerStats
+from utils.enums import Reason, Region
+
+class Recruit(BaseModel):
+    """member that left a watched clan, waiting to be posted on discord"""
+    reason: Reason
+    member: Member
+    clan_id: int
+    clan_name: str
+    region: Region = Region.EU
+    found_at: float = Field(default_factory=time.time)
+    stats: PlayerStats | None = None
@@ -23,3 +23,13 @@ class SaneArgumentParser(argparse.ArgumentParser):
         if ivalue < 0:
             raise argparse.ArgumentTypeError(f"{value} is an invalid non negative int value")
         return ivalue
+
+    @classmethod
+    def positive_int(cls, value):
+        """
+        Check if the value is an integer above zero.
+        """
+        ivalue = int(value)
+        if ivalue <= 0:
+            raise argparse.ArgumentTypeError(f"{value} is an invalid positive int value")
+        return ivalue
@@ -0,0 +1,24 @@
+"""Grouping of clan ids into API requests"""
+from utils.const import MAX_NUM_OF_IDS, MAX_BATCH_MEMBERS
+
+def plan_batches(clan_ids: list[str],
+                 members: list[int] = None,
+                 max_ids: int = MAX_NUM_OF_IDS,
+                 max_members: int = MAX_BATCH_MEMBERS) -> list[list[str]]:
+    """Split clan ids into batches of at most max_ids clans and, when the member
+    counts are known, at most max_members members, so large clans don't all end up
+    in the same response. A clan larger than max_members gets a batch of its own"""
+    if members is None:
+        return [clan_ids[i:i + max_ids] for i in range(0, len(clan_ids), max_ids)]
+    batches, batch, size = [], [], 0
+    for clan_id, count in zip(clan_ids, members):
+        # every clan costs at least one entry in the response
+        count = max(count or 0, 1)
+        if batch and (len(batch) == max_ids or size + count > max_members):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(clan_id)
+        size += count
+    if batch:
+        batches.append(batch)
+    return batches
@@ -1,7 +1,31 @@
 """constant used by bot"""
 NO_OF_CONSUMERS=5
 MAX_NUM_OF_IDS=100
-CLAN_URL = "https://api.worldoftanks.eu/wot/clans/list/"
-CLAN_DETAILS_URL = "https://api.worldoftanks.eu/wot/clans/info/"
-MEMBER_DETAILS_URL= "https://en.wot-life.com/eu/player/"
+# members in one clans/info response, a batch of 100 full clans holds 10.000
+MAX_BATCH_MEMBERS=3000
+DEFAULT_REGION = "eu"
+# every realm has its own API host
+CLAN_URLS = {
+    "eu": "https://api.worldoftanks.eu/wot/clans/list/",
+    "na": "https://api.worldoftanks.com/wot/clans/list/",
+    "asia": "https://api.worldoftanks.asia/wot/clans/list/",
+}
+CLAN_DETAILS_URLS = {
+    "eu": "https://api.worldoftanks.eu/wot/clans/info/",
+    "na": "https://api.worldoftanks.com/wot/clans/info/",
+    "asia": "https://api.worldoftanks.asia/wot/clans/info/",
+}
+MEMBER_DETAILS_URLS = {
+    "eu": "https://en.wot-life.com/eu/player/",
+    "na": "https://en.wot-life.com/na/player/",
+    "asia": "https://en.wot-life.com/asia/player/",
+}
+ACCOUNT_INFO_URLS = {
+    "eu": "https://api.worldoftanks.eu/wot/account/info/",
+    "na": "https://api.worldoftanks.com/wot/account/info/",
+    "asia": "https://api.worldoftanks.asia/wot/account/info/",
+}
 LOGGER_NAME="WOT_BOT"
+MEMBER_FIELDS = "name,clan_id,tag,is_clan_disbanded,old_name,members_count,description,members,updated_at"
+SUMMARY_FIELDS = "clan_id,members_count,updated_at,is_clan_disbanded"
+ACCOUNT_FIELDS = "last_battle_time,global_rating,statistics.all.battles,statistics.all.wins"
@@ -0,0 +1,183 @@
+"""Cache of recently notified players"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from utils.const import LOGGER_NAME
+from utils.storage import SQLITE_TIMEOUT
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class RecruitCache:
+    """Remembers when a player was last posted as a recruit.
+    Entries expire after ttl seconds, the least recently used entry is evicted
+    when the cache is full. Stored on disk so it survives restarts"""
+    def __init__(self, filename: str, ttl: int = 24 * 60 * 60, max_size: int = 100000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._logged = (0, 0)
+        self._entries = OrderedDict()
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def seen(self, account_id: int) -> bool:
+        """Check if a player was notified within the ttl, records the notification when not"""
+        now = time.time()
+        notified = self._entries.get(account_id)
+        if notified is not None and now - notified < self.ttl:
+            self.hits += 1
+            self._entries.move_to_end(account_id)
+            return True
+        self.misses += 1
+        self._entries[account_id] = now
+        self._entries.move_to_end(account_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return False
+
+    async def seen_many(self, account_ids: list[int]) -> set[int]:
+        """seen for every player of a response, returns the ones notified within the ttl"""
+        return {x for x in account_ids if self.seen(x)}
+
+    def load(self) -> None:
+        """Read entries that did not expire yet"""
+        try:
+            with open(self.filename, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as je:
+            logger.error("Cannot read recruit cache %s: %s", self.filename, je)
+            return
+        now = time.time()
+        for account_id, notified in entries:
+            if now - notified < self.ttl:
+                self._entries[account_id] = notified
+        logger.info("Loaded %d recently notified players", len(self._entries))
+
+    async def checkpoint(self) -> None:
+        """save from the event loop"""
+        self.save()
+
+    def save(self) -> None:
+        """Write the cache to disk"""
+        tmpfile = f"{self.filename}.tmp"
+        try:
+            with open(tmpfile, "w", encoding="utf-8") as file:
+                json.dump(list(self._entries.items()), file)
+            os.replace(tmpfile, self.filename)
+        except PermissionError as pe:
+            logger.error("Cannot store recruit cache: %s", pe.args[1])
+        if (self.hits, self.misses) != self._logged:
+            self._logged = (self.hits, self.misses)
+            logger.info("Recruit cache: %d players, %d repeat notifications suppressed, %d new",
+                        len(self._entries), self.hits, self.misses)
+
+class SharedRecruitCache:
+    """RecruitCache shared by bot instances on the same host through a sqlite file.
+    Checking and recording a notification is a single write transaction,
+    when two instances find the same player at the same time only one of them posts it"""
+    def __init__(self, filename: str, ttl: int = 24 * 60 * 60, max_size: int = 100000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._logged = (0, 0)
+        connection = self._connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS notified ("
+                               "account_id INTEGER PRIMARY KEY, notified REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS notified_at ON notified (notified)")
+        finally:
+            connection.close()
+
+    def __len__(self) -> int:
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT COUNT(*) FROM notified").fetchone()[0]
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Every call opens its own connection, so the work can run in a worker thread"""
+        return sqlite3.connect(self.filename, timeout=SQLITE_TIMEOUT, isolation_level=None)
+
+    def _seen_many(self, account_ids: list[int]) -> set[int]:
+        """One write transaction on its own connection, runs in a worker thread
+        so waiting for other instances never blocks the event loop"""
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                seen = set()
+                for account_id in dict.fromkeys(account_ids):
+                    row = connection.execute("SELECT notified FROM notified WHERE account_id=?",
+                                             (account_id,)).fetchone()
+                    if row is not None and now - row[0] < self.ttl:
+                        seen.add(account_id)
+                    else:
+                        connection.execute("INSERT OR REPLACE INTO notified VALUES (?, ?)", (account_id, now))
+                connection.execute("COMMIT")
+                return seen
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+        finally:
+            connection.close()
+
+    async def seen_many(self, account_ids: list[int]) -> set[int]:
+        """Check which players any instance notified about within the ttl,
+        records the notification of the others. When the database can't be used
+        every player counts as new, a repeat notification beats a lost recruit"""
+        try:
+            seen = await asyncio.to_thread(self._seen_many, account_ids)
+        except sqlite3.Error as se:
+            logger.error("Cannot check recruit cache, posting %d players: %s", len(account_ids), se)
+            return set()
+        self.hits += len(seen)
+        self.misses += len(set(account_ids)) - len(seen)
+        return seen
+
+    def _cleanup(self) -> int:
+        """Remove expired entries and the oldest ones above max_size, returns the number left"""
+        connection = self._connect()
+        try:
+            connection.execute("DELETE FROM notified WHERE notified < ?", (time.time() - self.ttl,))
+            connection.execute("DELETE FROM notified WHERE account_id NOT IN "
+                               "(SELECT account_id FROM notified ORDER BY notified DESC LIMIT ?)",
+                               (self.max_size,))
+            return connection.execute("SELECT COUNT(*) FROM notified").fetchone()[0]
+        finally:
+            connection.close()
+
+    async def checkpoint(self) -> None:
+        """save in a worker thread, other instances can hold the write lock for a while"""
+        try:
+            self._report(await asyncio.to_thread(self._cleanup))
+        except sqlite3.Error as se:
+            logger.error("Cannot clean up recruit cache: %s", se)
+
+    def save(self) -> None:
+        """Remove expired entries and the oldest ones above max_size"""
+        try:
+            self._report(self._cleanup())
+        except sqlite3.Error as se:
+            logger.error("Cannot clean up recruit cache: %s", se)
+
+    def _report(self, size: int) -> None:
+        if (self.hits, self.misses) != self._logged:
+            self._logged = (self.hits, self.misses)
+            logger.info("Recruit cache: %d players, %d repeat notifications suppressed, %d new",
+                        size, self.hits, self.misses)
@@ -0,0 +1,135 @@
+"""Deliver recruit notifications to a discord webhook"""
+import asyncio
+import logging
+import time
+
+import aiohttp
+from aiolimiter import AsyncLimiter
+from discord import Webhook, Embed, HTTPException
+
+from models import Recruit
+from utils.outbox import Outbox
+from utils.const import LOGGER_NAME, MEMBER_DETAILS_URLS
+from utils.metrics import RECRUITS_DELIVERED
+from utils.profiling import span
+from utils.enrich import RecruitEnricher
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# limits discord puts on a single webhook message
+MAX_EMBEDS = 10
+MAX_DESCRIPTION = 4096
+MAX_MESSAGE_CHARACTERS = 6000
+EMBED_COLOR = 2196944
+
+def member_line(recruit: Recruit) -> str:
+    """Single line describing a recruit, linking to the stats page of their region"""
+    member = recruit.member
+    stat_url = f"{MEMBER_DETAILS_URLS[recruit.region.value]}{member.account_name}-{member.account_id}/"
+    if recruit.stats is None:
+        return f"Name: {member.account_name} ID: {member.account_id} stats: {stat_url}"
+    stats = recruit.stats
+    last_battle = time.strftime("%Y-%m-%d", time.gmtime(stats.last_battle_time))
+    return (f"Name: {member.account_name} ID: {member.account_id} battles: {stats.battles} "
+            f"win rate: {stats.win_rate:.1f}% rating: {stats.global_rating} "
+            f"last battle: {last_battle} stats: {stat_url}")
+
+def build_embeds(recruits: list[tuple[int, Recruit]]) -> list[tuple[Embed, list[int]]]:
+    """Merge recruits of the same clan and reason into a single embed.
+    Embeds are split when the member list exceeds the description limit.
+    Every embed is returned with the outbox ids of the recruits it contains"""
+    groups = {}
+    for recruit_id, recruit in recruits:
+        groups.setdefault((recruit.clan_id, recruit.reason), []).append((recruit_id, recruit))
+    embeds = []
+    for (clan_id, reason), group in groups.items():
+        title = f"{len(group)} Member(s) Found"
+        first = group[0][1]
+        header = f"Reason: {reason}\nFrom Clan: {first.clan_name} {clan_id} ({first.region.name})\n"
+        description, ids = header, []
+        for recruit_id, recruit in group:
+            line = member_line(recruit) + "\n"
+            if len(description) + len(line) > MAX_DESCRIPTION:
+                embeds.append((Embed(title=title, description=description, color=EMBED_COLOR), ids))
+                description, ids = header, []
+            description += line
+            ids.append(recruit_id)
+        embeds.append((Embed(title=title, description=description, color=EMBED_COLOR), ids))
+    return embeds
+
+def pack_messages(embeds: list[tuple[Embed, list[int]]]) -> list[tuple[list[Embed], list[int]]]:
+    """Divide embeds over as few webhook messages as discord allows"""
+    messages = []
+    current, ids, characters = [], [], 0
+    for embed, embed_ids in embeds:
+        size = len(embed)
+        if current and (len(current) == MAX_EMBEDS or characters + size > MAX_MESSAGE_CHARACTERS):
+            messages.append((current, ids))
+            current, ids, characters = [], [], 0
+        current.append(embed)
+        ids.extend(embed_ids)
+        characters += size
+    if current:
+        messages.append((current, ids))
+    return messages
+
+async def recruit_members(queue: Outbox, url: str, batch_delay: float = 2,
+                          enricher: RecruitEnricher = None) -> None:
+    """Send recruit data to discord channel.
+    Webhooks are rate limited to 30 message per minute
+    according to stackoverflow. Recruits that arrive within batch_delay
+    of each other are sent together, discord.py follows the Retry-After
+    and X-RateLimit headers of the webhook.
+    Delivered recruits are acknowledged in the outbox, recruits of a message that
+    failed with a connection or server error are put back on the queue.
+    With an enricher the statistics of recruits are looked up first and recruits
+    that don't meet the rules are acknowledged without being sent"""
+    limiter = AsyncLimiter(30, 60)
+    async with aiohttp.ClientSession() as session:
+        webhook = Webhook.from_url(url, session=session) if url else None
+        while True:
+            received = [await queue.get()]
+            # give the parser a moment so a whole clan ends up in the same message
+            await asyncio.sleep(batch_delay)
+            while not queue.empty():
+                received.append(queue.get_nowait())
+            recruits, retry = received, []
+            try:
+                if not webhook:
+                    queue.ack([x[0] for x in recruits])
+                    continue
+                if enricher is not None:
+                    try:
+                        recruits, dropped = await enricher.enrich(recruits)
+                        queue.ack(dropped)
+                    except Exception: # pylint: disable=broad-exception-caught
+                        # statistics are optional, never stop posting recruits
+                        logger.exception("Cannot look up player statistics, posting recruits without them")
+                        recruits = received
+                    if not recruits:
+                        continue
+                logger.info("Sending %d recruits to discord", len(recruits))
+                by_id = dict(recruits)
+                messages = pack_messages(build_embeds(recruits))
+                for embeds, ids in messages:
+                    try:
+                        with span("deliver", recruits=len(ids)):
+                            async with limiter:
+                                await webhook.send(embeds=embeds, username='WOT_BOT')
+                        queue.ack(ids)
+                        RECRUITS_DELIVERED.inc(len(ids))
+                    except (aiohttp.ClientError, HTTPException) as se:
+                        logger.error("Error sending Data to discord recruit channel. Error: %s", se)
+                        if isinstance(se, HTTPException) and se.status < 500 and se.status != 429:
+                            # discord will never accept this message, don't retry it forever
+                            queue.ack(ids)
+                        else:
+                            retry.extend((x, by_id[x]) for x in ids)
+                lag = time.time() - min(x[1].found_at for x in recruits)
+                logger.info("Delivered %d recruits in %d messages, delivery lag %.1f seconds",
+                            len(recruits) - len(retry), len(messages), lag)
+            finally:
+                for _ in received:
+                    queue.task_done()
+            for item in retry:
+                queue.put_nowait(item)
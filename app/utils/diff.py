@@ -0,0 +1,50 @@
+"""Batched roster diffing using sorted account id arrays"""
+from typing import NamedTuple
+
+import numpy as np
+
+# account ids fit in 32 bits, the upper bits hold the position of the clan in the batch
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+class RosterDiff(NamedTuple):
+    """Changes in a single clan between two polls"""
+    clan_id: str
+    left: np.ndarray
+    joined: np.ndarray
+    disbanded: bool
+
+def roster_array(account_ids, dtype=np.int64) -> np.ndarray:
+    """Convert account ids to a sorted, unique array, int64 unless dtype says otherwise"""
+    return np.unique(np.fromiter(account_ids, dtype=dtype))
+
+def _batch_keys(rosters: list[np.ndarray]) -> np.ndarray:
+    """Tag every account id with the index of its clan.
+    Rosters are sorted, so the concatenated keys are sorted as well"""
+    if len(rosters) == 0:
+        return np.empty(0, dtype=np.int64)
+    sizes = np.fromiter((len(r) for r in rosters), dtype=np.int64, count=len(rosters))
+    index = np.repeat(np.arange(len(rosters), dtype=np.int64), sizes)
+    return (index << ID_BITS) | np.concatenate(rosters)
+
+def _split(keys: np.ndarray, count: int) -> list[np.ndarray]:
+    """Split tagged keys back into an account id array per clan"""
+    bounds = np.searchsorted(keys >> ID_BITS, np.arange(count + 1))
+    ids = keys & ID_MASK
+    return [ids[bounds[i]:bounds[i + 1]] for i in range(count)]
+
+def diff_batch(clan_ids: list[str],
+               old_rosters: list[np.ndarray],
+               new_rosters: list[np.ndarray],
+               old_disbanded: list[bool],
+               new_disbanded: list[bool]) -> list[RosterDiff]:
+    """Compute leavers, joiners and disband events for a whole batch of clans in one pass.
+    All lists are aligned on clan_ids"""
+    count = len(clan_ids)
+    old_keys = _batch_keys(old_rosters)
+    new_keys = _batch_keys(new_rosters)
+    left = _split(np.setdiff1d(old_keys, new_keys, assume_unique=True), count)
+    joined = _split(np.setdiff1d(new_keys, old_keys, assume_unique=True), count)
+    disbanded = ~np.asarray(old_disbanded, dtype=bool) & np.asarray(new_disbanded, dtype=bool)
+    return [RosterDiff(clan_ids[i], left[i], joined[i], bool(disbanded[i]))
+            for i in range(count)]
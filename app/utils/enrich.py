@@ -0,0 +1,140 @@
+"""Player statistics of recruits and the rules deciding who is posted"""
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import aiohttp
+
+from models import PlayerStats, Recruit
+from utils.const import LOGGER_NAME, ACCOUNT_INFO_URLS, ACCOUNT_FIELDS
+from utils.enums import Region
+from utils.fetcher import fetch
+from utils.http import ApiClient
+from utils.keys import KeyPool
+from utils.batching import plan_batches
+from utils import metrics
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class StatsCache:
+    """Player statistics by account id.
+    Entries expire after ttl seconds, the least recently used entry is evicted
+    when the cache is full. Hidden or deleted accounts are cached as None"""
+    def __init__(self, ttl: int = 6 * 60 * 60, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, account_id: int) -> tuple[bool, PlayerStats | None]:
+        """Cached statistics, the first value tells whether there was an entry"""
+        entry = self._entries.get(account_id)
+        if entry is None or time.time() - entry[0] >= self.ttl:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self._entries.move_to_end(account_id)
+        return True, entry[1]
+
+    def put(self, account_id: int, stats: PlayerStats | None) -> None:
+        """Store statistics that were just fetched"""
+        self._entries[account_id] = (time.time(), stats)
+        self._entries.move_to_end(account_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+@dataclass
+class RecruitRules:
+    """Requirements a recruit has to meet to be posted, 0 disables a rule"""
+    min_battles: int = 0
+    min_win_rate: float = 0
+    max_inactive_days: int = 0
+
+    def reject(self, stats: PlayerStats, now: float = None) -> str | None:
+        """Name of the first rule the player fails, None when the player is eligible"""
+        if stats.battles < self.min_battles:
+            return "battles"
+        if stats.win_rate < self.min_win_rate:
+            return "win_rate"
+        now = now or time.time()
+        if self.max_inactive_days and now - stats.last_battle_time > self.max_inactive_days * 24 * 60 * 60:
+            return "inactive"
+        return None
+
+def parse_account_response(response: dict, account_ids: list[str]) -> dict[int, PlayerStats | None]:
+    """Statistics of every requested account, empty when the request failed"""
+    if response.get('status') != 'ok':
+        logger.error("Player statistics query failed: %s", response.get('error') or "no response")
+        return {}
+    data = response.get('data') or {}
+    return {int(x): PlayerStats.from_api(data[x]) if data.get(x) else None for x in account_ids}
+
+class RecruitEnricher:
+    """Looks up the statistics of recruits before they are posted and drops the
+    ones that don't meet the rules. Accounts are requested in batches of up to 100
+    per region with the application IDs of the bot. Players without statistics,
+    because the account is hidden or the request failed, are always posted"""
+    def __init__(self,
+                 client: ApiClient,
+                 keys: dict[Region, KeyPool],
+                 rules: RecruitRules = None,
+                 cache: StatsCache = None):
+        self.client = client
+        self.keys = keys
+        self.rules = rules or RecruitRules()
+        self.cache = cache or StatsCache()
+
+    async def lookup(self, region: Region, account_ids: list[int]) -> dict[int, PlayerStats | None]:
+        """Statistics of accounts of one region, from the cache where possible"""
+        found, missing = {}, []
+        for account_id in account_ids:
+            hit, stats = self.cache.get(account_id)
+            if hit:
+                found[account_id] = stats
+            else:
+                missing.append(str(account_id))
+        if missing and region in self.keys:
+            for batch in plan_batches(missing):
+                params = {'account_id': ",".join(batch), "fields": ACCOUNT_FIELDS}
+                try:
+                    response = await fetch(ACCOUNT_INFO_URLS[region.value], params,
+                                           self.client, self.keys[region])
+                except aiohttp.ClientError as ce:
+                    logger.error("Error fetching player statistics. msg: %s", ce)
+                    continue
+                for account_id, stats in parse_account_response(response, batch).items():
+                    self.cache.put(account_id, stats)
+                    found[account_id] = stats
+        return found
+
+    async def enrich(self, recruits: list[tuple[int, Recruit]]) -> tuple[list[tuple[int, Recruit]], list[int]]:
+        """Attach statistics to recruits.
+        Returns the recruits to post and the outbox ids of the ones that were dropped"""
+        regions = {}
+        for _, recruit in recruits:
+            if recruit.stats is None:
+                regions.setdefault(recruit.region, set()).add(recruit.member.account_id)
+        stats = {}
+        for region, account_ids in regions.items():
+            stats.update(await self.lookup(region, sorted(account_ids)))
+        eligible, dropped = [], []
+        now = time.time()
+        for recruit_id, recruit in recruits:
+            if recruit.stats is None and stats.get(recruit.member.account_id) is not None:
+                recruit = recruit.model_copy(update={"stats": stats[recruit.member.account_id]})
+            rule = self.rules.reject(recruit.stats, now) if recruit.stats is not None else None
+            if rule:
+                metrics.RECRUITS_FILTERED.labels(rule).inc()
+                logger.debug("Not posting %s, fails the %s rule", recruit.member.account_name, rule)
+                dropped.append(recruit_id)
+            else:
+                eligible.append((recruit_id, recruit))
+        if dropped:
+            logger.info("Dropped %d of %d recruits that don't meet the recruit rules",
+                        len(dropped), len(recruits))
+        return eligible, dropped
@@ -5,6 +5,8 @@ class RequestType(Enum):
     """Type of requests"""
     ID = 'id'
     MEMBER = 'member'
+    SUMMARY = 'summary'
+    BASELINE = 'baseline'
 
     def __str__(self):
         return str(self.value)
@@ -16,3 +18,12 @@ class Reason(Enum):
 
     def __str__(self):
         return str(self.value)
+
+class Region(Enum):
+    """Wargaming realms"""
+    EU = "eu"
+    NA = "na"
+    ASIA = "asia"
+
+    def __str__(self):
+        return str(self.value)
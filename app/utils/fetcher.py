@@ -2,45 +2,213 @@
 import logging
 import random
 import asyncio
+import functools
+import time
+from typing import NamedTuple
+
 import aiohttp
 
-from aiolimiter import AsyncLimiter
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from utils.const import LOGGER_NAME
+from utils.enums import RequestType, Region
+from utils.keys import ApplicationKey, KeyPool, INVALID_KEY_ERRORS
+from utils.http import ApiClient
+from utils import metrics
+from utils.profiling import span, record_span, batch_args
 
 logger = logging.getLogger(LOGGER_NAME)
 
+# timed out attempts of a batch of several clans before it is split
+SPLIT_AFTER_TIMEOUTS = 2
+# errors caused by a clan of the batch, the other clans can be fetched without it
+CLAN_ERRORS = frozenset(("INVALID_CLAN_ID", "CLAN_ID_LIST_LIMIT_EXCEEDED"))
+
+class Request(NamedTuple):
+    """Request waiting to be sent to the API"""
+    request_type: RequestType
+    url: str
+    params: dict
+    region: Region = Region.EU
+    # time.perf_counter() when the request was queued, 0 when unknown
+    queued_at: float = 0.0
+
+class Response(NamedTuple):
+    """Decoded API response together with the request that produced it"""
+    request_type: RequestType
+    params: dict
+    data: dict
+    size: int
+    region: Region = Region.EU
+
+def is_rate_limited(response: dict) -> bool:
+    """The API reports exceeding the request limit in the body of a normal response"""
+    if not isinstance(response, dict) or response.get('status') != 'error':
+        return False
+    return (response.get('error') or {}).get('message') == 'REQUEST_LIMIT_EXCEEDED'
+
+def is_invalid_key(response: dict) -> bool:
+    """The API rejected the application ID itself"""
+    if not isinstance(response, dict) or response.get('status') != 'error':
+        return False
+    return (response.get('error') or {}).get('message') in INVALID_KEY_ERRORS
+
 async def fetch(url: str,
                 params: dict,
-                session: aiohttp.ClientSession,
-                limiter: AsyncLimiter,
+                client: ApiClient,
+                keys: KeyPool,
                 max_retries=5) -> dict:
     """Performs webrequests"""
+    data, _ = await fetch_raw(url, params, client, keys, max_retries)
+    return data
+
+async def send(session: aiohttp.ClientSession, url: str, params: dict) -> tuple[int, bytes]:
+    """Single GET, the body of throttled and timed out responses is not read"""
+    start = time.perf_counter()
+    async with session.get(url, params=params) as response:
+        body = b"" if response.status in (429, 504) else await response.read()
+    metrics.FETCH_LATENCY.labels(response.status).observe(time.perf_counter() - start)
+    return response.status, body
+
+async def fetch_raw(url: str,
+                    params: dict,
+                    client: ApiClient,
+                    keys: KeyPool,
+                    max_retries=5) -> tuple[dict, int]:
+    """Performs webrequests, returns the decoded response and the size of its body.
+    Every attempt is sent with the application ID the pool hands out,
+    a hedged copy of a slow attempt gets its own"""
+    data, size, _ = await _fetch_raw(url, params, client, keys, max_retries)
+    return data, size
+
+async def _fetch_raw(url: str,
+                     params: dict,
+                     client: ApiClient,
+                     keys: KeyPool,
+                     max_retries=5,
+                     max_timeouts: int = None) -> tuple[dict, int, bool]:
+    """fetch_raw that also tells whether the request was given up after max_timeouts
+    504s, read timeouts or dropped connections. Throttled attempts don't count"""
+    async def attempt(key: ApplicationKey = None) -> tuple[ApplicationKey, int, bytes]:
+        key = key or await keys.acquire()
+        status, body = await send(client.session, url, key.sign(params))
+        return key, status, body
+
+    timeouts = 0
     for retry in range(max_retries):
-        async with limiter:
-            async with session.get(url, params=params) as response:
-                if response.status in (429, 504):
-                    backoff_time = pow(2, retry + random.uniform(0,1))
-                    await asyncio.sleep(backoff_time)
-                else:
-                    return await response.json()
+        key = await keys.acquire()
+        try:
+            key, status, body = await client.hedged(functools.partial(attempt, key), attempt)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ce:
+            # dropped keep-alive connections and read timeouts
+            timeouts += 1
+            metrics.FETCH_RETRIES.labels("connection").inc()
+            logger.warning("Request to url: %s failed: %s", url, repr(ce))
+            if timeouts == max_timeouts:
+                metrics.FETCH_FAILURES.inc()
+                return {}, 0, True
+            backoff_time = pow(2, retry + random.uniform(0,1))
+            await asyncio.sleep(backoff_time)
+            continue
+        if status in (429, 504):
+            metrics.FETCH_RETRIES.labels("throttled" if status == 429 else "timeout").inc()
+            if status == 429:
+                key.throttled()
+            else:
+                timeouts += 1
+                if timeouts == max_timeouts:
+                    metrics.FETCH_FAILURES.inc()
+                    return {}, 0, True
+            backoff_time = pow(2, retry + random.uniform(0,1))
+            await asyncio.sleep(backoff_time)
+            continue
+        try:
+            data = json_loads(body)
+        except ValueError as ve:
+            # error pages of proxies and load balancers are not JSON
+            metrics.FETCH_RETRIES.labels("bad_response").inc()
+            logger.warning("Request to url: %s returned status %d without JSON: %s", url, status, ve)
+            backoff_time = pow(2, retry + random.uniform(0,1))
+            await asyncio.sleep(backoff_time)
+            continue
+        if is_rate_limited(data):
+            metrics.FETCH_RETRIES.labels("throttled").inc()
+            key.throttled()
+            backoff_time = pow(2, retry + random.uniform(0,1))
+            await asyncio.sleep(backoff_time)
+            continue
+        if is_invalid_key(data):
+            # another key can take the request right away
+            metrics.FETCH_RETRIES.labels("invalid_key").inc()
+            key.bench(data['error']['message'])
+            continue
+        key.succeeded()
+        return data, len(body), False
+    metrics.FETCH_FAILURES.inc()
     logger.error("Request to url: %s Max retries exceed", url)
-    return {}
+    return {}, 0, False
+
+def is_clan_error(response: dict) -> bool:
+    """The API rejected one of the clans of the request, not the request as a whole"""
+    if not isinstance(response, dict) or response.get('status') != 'error':
+        return False
+    error = response.get('error') or {}
+    return error.get('field') == 'clan_id' or error.get('message') in CLAN_ERRORS
+
+async def fetch_batch(url: str,
+                      params: dict,
+                      client: ApiClient,
+                      keys: KeyPool,
+                      max_retries=5) -> list[tuple[dict, dict, int]]:
+    """Fetch a batch of clans, returns (params, data, size) of every request made.
+    A batch of several clans that keeps timing out or is rejected because of one of its
+    clans is split in half and both halves are fetched, so a bad clan id or a response
+    that is too large only costs its own clans. Throttling and errors of the whole
+    request, like a blocked application ID, are returned as they are"""
+    clan_ids = params['clan_id'].split(',')
+    max_timeouts = None if len(clan_ids) == 1 else SPLIT_AFTER_TIMEOUTS
+    data, size, timed_out = await _fetch_raw(url, params, client, keys, max_retries, max_timeouts)
+    if len(clan_ids) == 1 or not (timed_out or is_clan_error(data)):
+        return [(params, data, size)]
+    half = len(clan_ids) // 2
+    metrics.BATCH_SPLITS.inc()
+    logger.warning("Request for %d clans failed: %s, retrying as batches of %d and %d clans",
+                   len(clan_ids), data.get('error') or "no response", half, len(clan_ids) - half)
+    results = []
+    for part in (clan_ids[:half], clan_ids[half:]):
+        results.extend(await fetch_batch(url, dict(params, clan_id=",".join(part)), client, keys, max_retries))
+    return results
 
 async def fetcher(request_queue: asyncio.Queue,
                   response_queue: asyncio.Queue,
-                  limiter: AsyncLimiter):
-    """manages web requests. Function is meant to have multiple copies running as tasks"""
+                  keys: KeyPool,
+                  client: ApiClient):
+    """manages web requests. Function is meant to have multiple copies running as tasks,
+    all sharing the connection pool of client.
+    A batch that was split is passed on as one response per part, a request that
+    fails is passed on with an empty response, so the parser can release its clans"""
     while True:
+        # only a request that was taken from the queue is marked as done
+        request = await request_queue.get()
+        if request.queued_at:
+            record_span("queue", request.queued_at, region=str(request.region), **batch_args(request.params))
         try:
-            async with aiohttp.ClientSession() as session:
-                while True:
-                    try:
-                        url, params = await request_queue.get()
-                        response = await fetch(url, params, session, limiter)
-                        await response_queue.put(response)
-                    finally:
-                        request_queue.task_done()
-        except (aiohttp.ServerDisconnectedError, aiohttp.ClientResponseError,
-                aiohttp.ClientConnectorError ) as se:
-            logger.error("Error fetching member Data. msg: %s", se.message)
+            results = [(request.params, {}, 0)]
+            with span(f"fetch {request.request_type}", **batch_args(request.params)):
+                try:
+                    results = await fetch_batch(request.url, request.params, client, keys)
+                except aiohttp.ClientError as ce:
+                    metrics.FETCH_FAILURES.inc()
+                    logger.error("Error fetching member Data. msg: %s", ce)
+                except Exception: # pylint: disable=broad-exception-caught
+                    # a single bad request must never stop a fetcher
+                    metrics.FETCH_FAILURES.inc()
+                    logger.exception("Unexpected error fetching %s", request.url)
+            for params, data, size in results:
+                await response_queue.put(Response(request.request_type, params, data, size,
+                                                  request.region))
+        finally:
+            request_queue.task_done()
@@ -0,0 +1,120 @@
+"""HTTP client shared by every request to the Wargaming API"""
+import argparse
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+import aiohttp
+from aiohttp.compression_utils import HAS_BROTLI
+
+from utils.const import LOGGER_NAME
+from utils import metrics
+
+logger = logging.getLogger(LOGGER_NAME)
+
+T = TypeVar("T")
+
+@dataclass
+class ClientConfig:
+    """Connection pool and timeout settings"""
+    pool_size: int = 10
+    keepalive: float = 30
+    dns_ttl: int = 300
+    connect_timeout: float = 10
+    read_timeout: float = 30
+    hedge_after: float = 0
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "ClientConfig":
+        """Settings from the options added by add_client_arguments"""
+        return cls(args.http_pool_size, args.http_keepalive, args.dns_cache_ttl,
+                   args.connect_timeout, args.read_timeout, args.hedge_after)
+
+def add_client_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options of the API client, shared by every script talking to the API"""
+    parser.add_argument('--http-pool-size',
+                        type=int,
+                        help="Connections kept open to every API host",
+                        default=os.environ.get("HTTP_POOL_SIZE", ClientConfig.pool_size))
+    parser.add_argument('--http-keepalive',
+                        type=float,
+                        help="Seconds an idle connection is kept open",
+                        default=os.environ.get("HTTP_KEEPALIVE", ClientConfig.keepalive))
+    parser.add_argument('--dns-cache-ttl',
+                        type=int,
+                        help="Seconds resolved API hosts are cached",
+                        default=os.environ.get("DNS_CACHE_TTL", ClientConfig.dns_ttl))
+    parser.add_argument('--connect-timeout',
+                        type=float,
+                        help="Seconds to wait for a connection to the API",
+                        default=os.environ.get("CONNECT_TIMEOUT", ClientConfig.connect_timeout))
+    parser.add_argument('--read-timeout',
+                        type=float,
+                        help="Seconds to wait for data on an open connection before the request is retried",
+                        default=os.environ.get("READ_TIMEOUT", ClientConfig.read_timeout))
+    parser.add_argument('--hedge-after',
+                        type=float,
+                        help="Send a second copy of a request that has not finished after this many seconds, \
+                            the first response wins. 0 disables hedging",
+                        default=os.environ.get("HEDGE_AFTER", ClientConfig.hedge_after))
+
+class ApiClient:
+    """One aiohttp session with a tuned connection pool.
+    Connections are kept alive and reused by every consumer, hosts are resolved
+    once per dns_ttl and compressed responses are requested"""
+    def __init__(self, config: ClientConfig = None):
+        self.config = config or ClientConfig()
+        self.session = None
+
+    async def open(self) -> "ApiClient":
+        """Create the session, has to run inside the event loop"""
+        connector = aiohttp.TCPConnector(limit=0,
+                                         limit_per_host=self.config.pool_size,
+                                         keepalive_timeout=self.config.keepalive,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=self.config.dns_ttl)
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=self.config.connect_timeout,
+                                        sock_read=self.config.read_timeout)
+        encodings = "gzip, deflate, br" if HAS_BROTLI else "gzip, deflate"
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                             headers={"Accept-Encoding": encodings})
+        logger.debug("Opened API client: %s, accepting %s", self.config, encodings)
+        return self
+
+    async def close(self) -> None:
+        """Close every pooled connection"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self) -> "ApiClient":
+        return await self.open()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def hedged(self, attempt: Callable[[], Awaitable[T]],
+                     hedge: Callable[[], Awaitable[T]] = None) -> T:
+        """Run attempt, when it did not finish within hedge_after a second copy made by hedge
+        is started and the first one to succeed wins, the other is cancelled"""
+        if self.config.hedge_after <= 0:
+            return await attempt()
+        pending = {asyncio.ensure_future(attempt())}
+        done, pending = await asyncio.wait(pending, timeout=self.config.hedge_after)
+        if not done:
+            metrics.FETCH_RETRIES.labels("hedged").inc()
+            pending.add(asyncio.ensure_future((hedge or attempt)()))
+        try:
+            while True:
+                if not done:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                task = done.pop()
+                if task.exception() is None or not (pending or done):
+                    return task.result()
+                # the other copy can still succeed
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,98 @@
+"""Accounting of clans between being queued and parsed"""
+import asyncio
+import logging
+import time
+
+from utils.const import LOGGER_NAME
+from utils.enums import Region
+from utils import metrics
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class InFlight:
+    """Clans that were queued for a request and are not parsed yet.
+    Producers wait until fewer than limit clans of their region are in flight, which bounds
+    every queue of the pipeline, and skip clans that are still in flight from an earlier cycle.
+    A poll cycle ends when the last of its clans is released"""
+    def __init__(self, limit: int, update_interval: int = 0):
+        self.limit = limit
+        self.update_interval = update_interval
+        self._clans = {}
+        self._regions = {}
+        self._cycles = {}
+        self._next_cycle = 1
+        self._room = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._clans)
+
+    def __contains__(self, clan_id: str) -> bool:
+        return clan_id in self._clans
+
+    def start_cycle(self) -> int:
+        """Begin accounting a new poll cycle"""
+        cycle = self._next_cycle
+        self._next_cycle += 1
+        self._cycles[cycle] = {"start": time.monotonic(), "remaining": 0, "clans": 0,
+                               "skipped": 0, "queued": False}
+        return cycle
+
+    def end_cycle(self, cycle: int) -> None:
+        """Every clan of the cycle is queued, it is done once they are all parsed"""
+        self._cycles[cycle]["queued"] = True
+        self._finish(cycle)
+
+    def in_region(self, region: Region = None) -> int:
+        """Clans of a region that are in flight"""
+        return self._regions.get(region, 0)
+
+    async def admit(self, clan_ids: list[str], cycle: int = None, region: Region = None) -> list[str]:
+        """Wait for room in the pipeline of the region and mark clans as in flight.
+        Returns the clans that were not in flight yet"""
+        new = [x for x in clan_ids if x not in self._clans]
+        if cycle is not None:
+            self._cycles[cycle]["skipped"] += len(clan_ids) - len(new)
+        # a batch larger than the limit is let through once the region is empty
+        while new and self.in_region(region) and self.in_region(region) + len(new) > self.limit:
+            self._room.clear()
+            await self._room.wait()
+            # clans can have been admitted by another producer while waiting
+            new = [x for x in new if x not in self._clans]
+        for clan_id in new:
+            self._clans[clan_id] = (cycle, region)
+        self._regions[region] = self.in_region(region) + len(new)
+        if cycle is not None:
+            self._cycles[cycle]["remaining"] += len(new)
+            self._cycles[cycle]["clans"] += len(new)
+        return new
+
+    def release(self, clan_ids) -> None:
+        """Clans are parsed or their request failed"""
+        finished = set()
+        for clan_id in clan_ids:
+            if clan_id not in self._clans:
+                continue
+            cycle, region = self._clans.pop(clan_id)
+            self._regions[region] -= 1
+            if cycle is not None:
+                self._cycles[cycle]["remaining"] -= 1
+                finished.add(cycle)
+        for cycle in finished:
+            self._finish(cycle)
+        self._room.set()
+
+    def _finish(self, cycle: int) -> None:
+        """Report a cycle once it is queued and all of its clans are released"""
+        state = self._cycles[cycle]
+        if not state["queued"] or state["remaining"] > 0:
+            return
+        del self._cycles[cycle]
+        duration = time.monotonic() - state["start"]
+        metrics.POLL_CYCLE.observe(duration)
+        logger.info("Poll cycle %d finished in %.1f seconds, %d clans polled, %d skipped as still in flight",
+                    cycle, duration, state["clans"], state["skipped"])
+        if self.update_interval and duration > self.update_interval:
+            logger.warning("Poll cycle %d took %.1f seconds, longer than the update interval of %d seconds. "
+                           "Clans still in flight are skipped by the next cycle, "
+                           "raise --update-interval or add application IDs",
+                           cycle, duration, self.update_interval)
@@ -0,0 +1,111 @@
+"""Pool of Wargaming application IDs, each with its own request quota"""
+import asyncio
+import logging
+import time
+
+from utils.const import LOGGER_NAME
+from utils.limiter import AdaptiveLimiter
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# errors after which a key is useless until someone fixes it in the developer portal
+INVALID_KEY_ERRORS = ("INVALID_APPLICATION_ID", "APPLICATION_IS_BLOCKED", "INVALID_IP_ADDRESS")
+
+class ApplicationKey:
+    """Application ID with its own limiter and health state.
+    A key that keeps hitting the rate limit or is rejected by the API
+    is benched, the bench time doubles every time it happens again"""
+    def __init__(self,
+                 application_id: str,
+                 limiter: AdaptiveLimiter,
+                 bench_time: float = 60,
+                 max_bench_time: float = 60 * 60,
+                 max_throttles: int = 3):
+        self.application_id = application_id
+        self.limiter = limiter
+        self.bench_time = bench_time
+        self.max_bench_time = max_bench_time
+        self.max_throttles = max_throttles
+        self.benched_until = 0.0
+        self.requests = 0
+        self._throttles = 0
+        self._benches = 0
+
+    @property
+    def healthy(self) -> bool:
+        """key is in rotation"""
+        return time.monotonic() >= self.benched_until
+
+    def sign(self, params: dict) -> dict:
+        """request parameters using this key"""
+        return dict(params, application_id=self.application_id)
+
+    def succeeded(self) -> None:
+        """Register a successful response"""
+        self.limiter.succeeded()
+        self._throttles = 0
+        self._benches = 0
+
+    def throttled(self) -> None:
+        """Register a response that hit the rate limit of this key"""
+        self.limiter.throttled()
+        self._throttles += 1
+        if self._throttles >= self.max_throttles:
+            self.bench(f"rate limit exceeded {self._throttles} times in a row")
+
+    def bench(self, reason: str) -> None:
+        """Take the key out of rotation for a while"""
+        if not self.healthy:
+            # responses of requests that were already in flight
+            return
+        seconds = min(self.bench_time * 2 ** self._benches, self.max_bench_time)
+        self._benches += 1
+        self._throttles = 0
+        self.benched_until = time.monotonic() + seconds
+        logger.warning("Application ID ...%s out of rotation for %.0f seconds: %s",
+                       self.application_id[-4:], seconds, reason)
+
+class KeyPool:
+    """Rotates requests over application IDs.
+    Every request goes to the healthy key that can send first, so the pool
+    uses the combined quota of all keys"""
+    def __init__(self, application_ids: list[str], rate: float = 10, max_rate: float = 20):
+        if not application_ids:
+            raise ValueError("At least one application ID is required")
+        self.keys = [ApplicationKey(x, AdaptiveLimiter(rate=rate, max_rate=max_rate))
+                     for x in application_ids]
+
+    @classmethod
+    def from_string(cls, application_ids: str, rate: float = 10, max_rate: float = 20) -> "KeyPool":
+        """Pool from a comma separated list of IDs"""
+        return cls([x.strip() for x in (application_ids or "").split(",") if x.strip()],
+                   rate, max_rate)
+
+    @property
+    def rate(self) -> float:
+        """combined rate of the healthy keys in requests per second"""
+        return sum(x.limiter.rate for x in self.keys if x.healthy)
+
+    async def acquire(self) -> ApplicationKey:
+        """Wait until a key is allowed to send a request and return it"""
+        while True:
+            healthy = [x for x in self.keys if x.healthy]
+            if healthy:
+                key = min(healthy, key=lambda x: x.limiter.next_slot)
+                await key.limiter.acquire()
+                if not key.healthy:
+                    # benched while waiting for its slot
+                    continue
+                key.requests += 1
+                return key
+            wait = min(x.benched_until for x in self.keys) - time.monotonic()
+            logger.error("All application IDs are out of rotation, waiting %.0f seconds", wait)
+            await asyncio.sleep(max(wait, 0))
+
+    def report(self) -> None:
+        """Log the state of every key"""
+        for key in self.keys:
+            state = "in rotation" if key.healthy else \
+                f"benched for {key.benched_until - time.monotonic():.0f} seconds"
+            logger.info("Application ID ...%s: %.1f requests per second, %d requests, %s",
+                        key.application_id[-4:], key.limiter.rate, key.requests, state)
@@ -0,0 +1,70 @@
+"""On-disk cache of language classifications"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from importlib import metadata
+from typing import Iterable
+
+from utils.const import LOGGER_NAME
+from utils.storage import SQLITE_BATCH_SIZE
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def model_version(model_path: str = None) -> str:
+    """Identifies the model, results of another model are never reused"""
+    if not model_path:
+        return f"fast-langdetect-{metadata.version('fast-langdetect')}"
+    digest = hashlib.blake2b(digest_size=16)
+    with open(model_path, "rb") as file:
+        while block := file.read(1 << 20):
+            digest.update(block)
+    return f"{os.path.basename(model_path)}-{digest.hexdigest()}"
+
+def description_key(lines: list[str], model: str) -> str:
+    """Hash of the normalized description and the model version"""
+    text = model + "\0" + "\n".join(lines)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+class LanguageCache:
+    """Per language votes and scores of descriptions that were classified before.
+    Stored in sqlite, so a rerun only classifies new or edited descriptions"""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS languages ("
+                                 "key TEXT PRIMARY KEY, votes TEXT, scores TEXT)")
+        self._batch = []
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, tuple[dict, dict]]:
+        """Cached (votes, scores) of every known key"""
+        keys = list(keys)
+        found = {}
+        # stay below the sqlite limit on query parameters
+        for i in range(0, len(keys), SQLITE_BATCH_SIZE // 2):
+            batch = keys[i:i + SQLITE_BATCH_SIZE // 2]
+            query = f"SELECT key, votes, scores FROM languages WHERE key IN ({','.join('?' * len(batch))})"
+            for key, votes, scores in self._connection.execute(query, batch):
+                found[key] = (json.loads(votes), json.loads(scores))
+        return found
+
+    def put(self, key: str, votes: dict, scores: dict) -> None:
+        """Remember a classification, written in batches"""
+        self._batch.append((key, json.dumps(votes), json.dumps(scores)))
+        if len(self._batch) >= SQLITE_BATCH_SIZE:
+            self.commit()
+
+    def commit(self) -> None:
+        """Write remembered classifications"""
+        if not self._batch:
+            return
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO languages VALUES (?, ?, ?)", self._batch)
+        self._batch = []
+
+    def close(self) -> None:
+        """Write remaining classifications and close the database"""
+        self.commit()
+        self._connection.close()
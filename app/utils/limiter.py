@@ -0,0 +1,71 @@
+"""Adaptive rate limiter for the Wargaming API"""
+import asyncio
+import logging
+import time
+
+from utils.const import LOGGER_NAME
+from utils.metrics import LIMITER_WAIT
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class AdaptiveLimiter:
+    """Rate limiter using additive increase, multiplicative decrease (AIMD).
+    Every successful response raises the rate a little, a throttled response cuts it.
+    Requests are spaced evenly at the current rate.
+    Used as `async with limiter:` just like aiolimiter.AsyncLimiter"""
+    def __init__(self,
+                 rate: float = 10,
+                 min_rate: float = 1,
+                 max_rate: float = 20,
+                 increase: float = 0.5,
+                 decrease: float = 0.5,
+                 cooldown: float = 1):
+        self._rate = min(max(rate, min_rate), max_rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        # requests per second gained per second of successful responses
+        self.increase = increase
+        self.decrease = decrease
+        # throttled responses of requests that were already in flight are ignored
+        self.cooldown = cooldown
+        self._next_slot = 0.0
+        self._last_decrease = 0.0
+
+    @property
+    def rate(self) -> float:
+        """current rate in requests per second"""
+        return self._rate
+
+    @property
+    def next_slot(self) -> float:
+        """monotonic time at which the next request may be sent"""
+        return max(time.monotonic(), self._next_slot)
+
+    async def acquire(self) -> None:
+        """Wait until the next request is allowed"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self._rate
+        LIMITER_WAIT.observe(slot - now)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def succeeded(self) -> None:
+        """Register a successful response"""
+        self._rate = min(self.max_rate, self._rate + self.increase / self._rate)
+
+    def throttled(self) -> None:
+        """Register a response that hit the API rate limit"""
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self._rate = max(self.min_rate, self._rate * self.decrease)
+        logger.info("Wargaming API rate limit hit, lowering rate to %.1f requests per second",
+                    self._rate)
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        return None
@@ -0,0 +1,166 @@
+"""Pipeline metrics exposed in the Prometheus text format"""
+import bisect
+import logging
+import math
+from typing import Callable
+
+from aiohttp import web
+
+from utils.const import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{x}="{y}"' for x, y in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+class Metric:
+    """Metric with optional labels, children are created on first use"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self._children = {}
+
+    def labels(self, *values) -> "Metric":
+        """Child for a combination of label values"""
+        values = tuple(str(x) for x in values)
+        if values not in self._children:
+            self._children[values] = self._new_child()
+        return self._children[values]
+
+    def _new_child(self) -> "Metric":
+        return self.__class__(self.name, self.documentation)
+
+    def samples(self) -> list[str]:
+        """Lines of every child"""
+        if not self.label_names:
+            return self._samples(())
+        lines = []
+        for values, child in self._children.items():
+            lines.extend(child._samples(values, self.label_names)) # pylint: disable=protected-access
+        return lines
+
+    def _samples(self, values: tuple, names: tuple = ()) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Metric in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+class Counter(Metric):
+    """Value that only goes up"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """Add to the counter"""
+        self.value += amount
+
+    def _samples(self, values: tuple, names: tuple = ()) -> list[str]:
+        return [f"{self.name}{_labels(names, values)} {_number(self.value)}"]
+
+class Gauge(Metric):
+    """Value that goes up and down, or is read from a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.value = 0.0
+        self.callback = None
+
+    def set(self, value: float) -> None:
+        """Set the current value"""
+        self.value = value
+
+    def set_function(self, callback: Callable[[], float]) -> None:
+        """Read the value when scraped"""
+        self.callback = callback
+
+    def _samples(self, values: tuple, names: tuple = ()) -> list[str]:
+        value = self.callback() if self.callback else self.value
+        return [f"{self.name}{_labels(names, values)} {_number(value)}"]
+
+class Histogram(Metric):
+    """Distribution of observed values over cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        """Record a value"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def _samples(self, values: tuple, names: tuple = ()) -> list[str]:
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            le = f'le="{_number(bound)}"'
+            lines.append(f"{self.name}_bucket{_labels(names, values, le)} {total}")
+        lines.append(f"{self.name}_sum{_labels(names, values)} {_number(self.sum)}")
+        lines.append(f"{self.name}_count{_labels(names, values)} {total}")
+        return lines
+
+REGISTRY: list[Metric] = []
+
+def _register(metric: Metric) -> Metric:
+    REGISTRY.append(metric)
+    return metric
+
+QUEUE_DEPTH = _register(Gauge("wot_queue_depth", "Items waiting in a pipeline queue", ("queue",)))
+LIMITER_WAIT = _register(Histogram("wot_limiter_wait_seconds", "Time a request waited for the rate limiter"))
+FETCH_LATENCY = _register(Histogram("wot_fetch_seconds", "Duration of a single API request", ("status",)))
+FETCH_RETRIES = _register(Counter("wot_fetch_retries_total", "API requests that were retried", ("reason",)))
+FETCH_FAILURES = _register(Counter("wot_fetch_failures_total", "API requests that ran out of retries"))
+BATCH_SPLITS = _register(Counter("wot_batch_splits_total", "Failed batches that were split in half and retried"))
+PARSE_TIME = _register(Histogram("wot_parse_seconds", "Time spent parsing one response", ("type",)))
+CLANS_CHANGED = _register(Counter("wot_clans_changed_total", "Clans whose member list changed"))
+RECRUITS_FOUND = _register(Counter("wot_recruits_found_total", "Recruits queued for discord", ("reason",)))
+RECRUITS_FILTERED = _register(Counter("wot_recruits_filtered_total",
+                                      "Recruits dropped by a filter rule before delivery", ("rule",)))
+RECRUITS_DELIVERED = _register(Counter("wot_recruits_delivered_total", "Recruits posted on discord"))
+POLL_CYCLE = _register(Histogram("wot_poll_cycle_seconds", "Time until every request of a poll cycle was fetched"))
+
+def render() -> str:
+    """All metrics in the Prometheus text format"""
+    return "\n".join(x.render() for x in REGISTRY) + "\n"
+
+async def metrics_handler(_request: web.Request) -> web.Response:
+    """GET /metrics"""
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+async def serve_metrics(port: int, host: str = "0.0.0.0", routes: list[web.RouteDef] = ()) -> web.AppRunner:
+    """Serve /metrics and any extra admin routes from the running event loop"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Serving metrics on port %d", port)
+    return runner
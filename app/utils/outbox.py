@@ -0,0 +1,116 @@
+"""Durable queue for recruit notifications"""
+import asyncio
+import json
+import logging
+import os
+
+from pydantic import ValidationError
+
+from models import Recruit
+from utils.const import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class Outbox(asyncio.Queue):
+    """Queue of recruits backed by an append only log.
+    Every recruit put on the queue is logged, the discord sender acknowledges
+    recruits once delivered. Recruits that were never acknowledged are replayed on startup.
+    New entries are fsynced in batches by flush, acknowledgements right away.
+    The log is compacted to the pending recruits when it grows beyond compact_size"""
+    def __init__(self, filename: str, flush_interval: float = 1.0, compact_size: int = 1024 * 1024):
+        super().__init__()
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.compact_size = compact_size
+        self._next_id = 1
+        self._pending = {}
+        self._buffer = []
+        self._replay()
+        self._file = open(filename, "a", encoding="utf-8")
+        self._compact_at = max(compact_size, 2 * self._file.tell())
+
+    def _replay(self) -> None:
+        """Queue recruits that were not delivered by a previous run and compact the log"""
+        try:
+            with open(self.filename, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        if "recruit" in entry:
+                            self._pending[entry["id"]] = Recruit(**entry["recruit"])
+                        else:
+                            self._pending.pop(entry["id"], None)
+                        self._next_id = max(self._next_id, entry["id"] + 1)
+                    except (json.JSONDecodeError, KeyError, ValidationError) as e:
+                        # last line can be cut off when the bot was killed
+                        logger.error("Skipping damaged outbox entry: %s", e)
+        except FileNotFoundError:
+            return
+        self._rewrite()
+        for recruit_id, recruit in sorted(self._pending.items()):
+            self.put_nowait((recruit_id, recruit))
+        if self._pending:
+            logger.info("Replaying %d undelivered recruits from %s", len(self._pending), self.filename)
+
+    def _rewrite(self) -> None:
+        """Replace the log with only the entries that are still pending"""
+        tmpfile = f"{self.filename}.tmp"
+        with open(tmpfile, "w", encoding="utf-8") as file:
+            for recruit_id, recruit in sorted(self._pending.items()):
+                file.write(self._add_line(recruit_id, recruit))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmpfile, self.filename)
+
+    @staticmethod
+    def _add_line(recruit_id: int, recruit: Recruit) -> str:
+        return json.dumps({"id": recruit_id, "recruit": recruit.model_dump(mode="json")}) + "\n"
+
+    def _put(self, item: Recruit | tuple[int, Recruit]) -> None:
+        """Log a new recruit, the queue hands out (id, recruit) tuples.
+        Tuples are recruits that are already logged, either replayed or put back after a failed delivery"""
+        if isinstance(item, tuple):
+            super()._put(item)
+            return
+        recruit_id = self._next_id
+        self._next_id += 1
+        self._pending[recruit_id] = item
+        self._buffer.append(self._add_line(recruit_id, item))
+        super()._put((recruit_id, item))
+
+    def flush(self) -> None:
+        """Write logged recruits to disk"""
+        if not self._buffer:
+            return
+        self._file.writelines(self._buffer)
+        self._buffer = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def ack(self, recruit_ids: list[int]) -> None:
+        """Mark recruits as delivered"""
+        for recruit_id in recruit_ids:
+            self._pending.pop(recruit_id, None)
+            self._buffer.append(json.dumps({"id": recruit_id}) + "\n")
+        self.flush()
+        if self._file.tell() > self._compact_at:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Rewrite the log with only the pending recruits, also while a backlog never drains.
+        The next compaction waits until the log doubled so a large backlog is not rewritten on every ack"""
+        self._file.close()
+        self._rewrite()
+        self._file = open(self.filename, "a", encoding="utf-8")
+        self._compact_at = max(self.compact_size, 2 * self._file.tell())
+
+    async def run(self) -> None:
+        """Periodically write new recruits to disk"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self) -> None:
+        """Write remaining entries and close the log"""
+        self.flush()
+        self._file.close()
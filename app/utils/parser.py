@@ -1,68 +1,252 @@
 """Contain functions for parsing responses"""
 import logging
 import asyncio
+import time
 
+import numpy as np
 from pydantic import ValidationError
 
-from models import Clan
-from utils.const import LOGGER_NAME
-from utils.enums import Reason
+from models import Clan, Recruit, text_fields_hash
+from utils.const import LOGGER_NAME, CLAN_DETAILS_URLS, MEMBER_FIELDS
+from utils.enums import Reason, RequestType, Region
+from utils.diff import diff_batch, roster_array, RosterDiff
+from utils.fetcher import Request
+from utils.stats import PollStats
+from utils.scheduler import PollScheduler
+from utils.dedup import RecruitCache
+from utils.inflight import InFlight
+from utils.batching import plan_batches
+from utils.state import CompactClans
+from utils import metrics
+from utils.profiling import span, batch_args
 logger = logging.getLogger(LOGGER_NAME)
 
+TEXT_FIELDS = ("name", "tag", "old_name", "description")
+
 async def parse_response(response_queue: asyncio.Queue,
                         recruit_queue: asyncio.Queue,
-                        clans: dict[Clan]):
-    """Parse data retrieved from Wargames API"""
+                        clans: dict[Clan],
+                        changed: set[str] = None,
+                        request_queues: dict[Region, asyncio.Queue] = None,
+                        stats: PollStats = None,
+                        scheduler: PollScheduler = None,
+                        dedup: RecruitCache = None,
+                        inflight: InFlight = None):
+    """Parse data retrieved from Wargames API.
+    Summary responses queue full member requests on the request queue of their region
+    for clans that changed. Clans are released from inflight once parsed, also when
+    their request failed"""
     while True:
-        response = await response_queue.get()
+        request_type, params, response, size, region = await response_queue.get()
         logger.debug("Parsing response: %s", response)
-
-        if len(response) == 0:
-            logger.error("Empty response")
+        followed_up = []
+        try:
+            if len(response) == 0:
+                logger.error("Empty response")
+                continue
+            if response.get('status') != 'ok':
+                logger.error("query failed: %s", response.get('error'))
+                continue
+            if not response.get('meta'):
+                logger.error("Received an incorrect response. Missing mandatory fiel meta.\
+                    Response: %s", response)
+                continue
+            if response.get('meta').get('count') == 0:
+                logger.error("No results for query")
+                continue
+            data = response.get('data')
+            start = time.perf_counter()
+            if request_type == RequestType.SUMMARY:
+                with span("parse summary", **batch_args(params)):
+                    updated = find_updated_clans(data, clans)
+                metrics.PARSE_TIME.labels("summary").observe(time.perf_counter() - start)
+                # the clans stay in flight until their members are parsed
+                followed_up = updated
+                for batch in plan_batches(updated, [data[x].get('members_count') for x in updated]):
+                    member_params = dict(params, clan_id=",".join(batch), fields=MEMBER_FIELDS)
+                    await request_queues[region].put(Request(RequestType.MEMBER, CLAN_DETAILS_URLS[region.value],
+                                                             member_params, region, time.perf_counter()))
+                if stats:
+                    stats.record_summary(size, len(data), len(updated))
+                if scheduler:
+                    for clan_id in data.keys() - set(updated):
+                        if clan_id in clans:
+                            scheduler.observe(clan_id, 0)
+            elif request_type == RequestType.BASELINE:
+                with span("parse baseline", **batch_args(params)):
+                    store_baseline(data, clans, changed)
+                metrics.PARSE_TIME.labels("baseline").observe(time.perf_counter() - start)
+            else:
+                with span("parse member", **batch_args(params)):
+                    await parse_members(data, recruit_queue, clans, changed, scheduler, dedup)
+                elapsed = time.perf_counter() - start
+                metrics.PARSE_TIME.labels("member").observe(elapsed)
+                if stats:
+                    stats.record_members(size, len(data), elapsed)
+        finally:
+            if inflight is not None:
+                inflight.release(set(params.get('clan_id', '').split(',')) - set(followed_up))
             response_queue.task_done()
+
+def find_updated_clans(data: dict[dict], clans: dict[Clan]) -> list[str]:
+    """Compare the cheap summary fields with the stored clans.
+    Returns the ids of clans whose member list has to be fetched"""
+    updated = []
+    for clan_id, entry in data.items():
+        clan = clans.get(clan_id)
+        if not clan:
+            logger.error("Retrieved clan data which was not requested: ID %s", clan_id)
             continue
-        if response.get('status') != 'ok':
-            logger.error("query failed: %s", response.get('error'))
-            response_queue.task_done()
+        if not entry:
+            logger.error("No summary for clan %s with ID %s", clan.name, clan_id)
             continue
-        if not response.get('meta'):
-            logger.error("Received an incorrect response. Missing mandatory fiel meta.\
-                Response: %s", response)
-            response_queue.task_done()
+        if (entry.get('members_count') != clan.members_count or
+                (entry.get('updated_at') or 0) != clan.updated_at or
+                entry.get('is_clan_disbanded') != clan.is_clan_disbanded):
+            updated.append(clan_id)
+    return updated
+
+def is_unchanged(clan: Clan, entry: dict) -> bool:
+    """Compare a raw API entry with the stored clan without building any models.
+    Only the member ids are compared, renamed members or new roles are picked up
+    the next time the roster changes"""
+    try:
+        members = entry['members']
+        if len(members) != len(clan.roster):
+            return False
+        if (entry.get('members_count') != clan.members_count or
+                (entry.get('updated_at') or 0) != clan.updated_at or
+                entry.get('is_clan_disbanded') != clan.is_clan_disbanded):
+            return False
+        text = [entry.get(x) for x in TEXT_FIELDS]
+        text = [x.strip() if isinstance(x, str) else x for x in text]
+        if text_fields_hash(*text) != clan.fields_hash:
+            return False
+        return np.array_equal(roster_array(x['account_id'] for x in members), clan.roster)
+    except (KeyError, TypeError):
+        return False
+
+def store_baseline(data: dict[dict], clans: dict[Clan], changed: set[str] = None) -> None:
+    """Replace the stored rosters of newly watched clans without looking for recruits,
+    members that left before the clan was watched are not reported"""
+    for clan_id, entry in data.items():
+        clan = clans.get(clan_id)
+        if not clan or not entry:
+            logger.error("No baseline for clan with ID %s", clan_id)
             continue
-        if response.get('meta').get('count') == 0:
-            logger.error("No results for query")
-            response_queue.task_done()
+        try:
+            clans[clan_id] = Clan(**dict(entry, region=clan.region))
+        except ValidationError as ve:
+            logger.error("Error parsing data: %s with error %s", entry, ve.args)
             continue
-        await parse_members(response.get('data'), recruit_queue, clans)
-        response_queue.task_done()
+        if changed is not None:
+            changed.add(clan_id)
+
+def has_changed(clan: Clan, tmpclan: Clan, diff: RosterDiff) -> bool:
+    """Check if a clan has to be written back to storage"""
+    if len(diff.left) > 0 or len(diff.joined) > 0:
+        return True
+    return (clan.members_count != tmpclan.members_count or
+            clan.updated_at != tmpclan.updated_at or
+            clan.is_clan_disbanded != tmpclan.is_clan_disbanded or
+            clan.fields_hash != tmpclan.fields_hash)
 
 async def parse_members(data: list[dict],
                         recruit_queue: asyncio.Queue,
-                        clans: dict[Clan]):
-    """ parses member data"""
+                        clans: dict[Clan],
+                        changed: set[str] = None,
+                        scheduler: PollScheduler = None,
+                        dedup: RecruitCache = None):
+    """ parses member data.
+    IDs of clans that differ from the stored version are added to changed.
+    Players that were notified about recently according to dedup are not queued again"""
+    updated, stored = {}, {}
     for clan_id, entry in data.items():
         try:
-            tmpclan = Clan(**entry)
             clan = clans.get(clan_id)
             if not clan:
                 logger.error("Retrieved clan data which was not requested: ID %s", clan_id)
                 continue
-            if clan.members != tmpclan.members:
-                left_members = [x for x in clan.members if x not in tmpclan.members]
-                for member in left_members:
-                    logger.info("Found member %s that left the clan: %s",
-                                member.account_name, clan.name)
-                    await recruit_queue.put((Reason.LEFT, member, clan))
-            if not clan.is_clan_disbanded and tmpclan.is_clan_disbanded:
-                logger.info("Clan %s disbanded, All members are potential recruits", clan.name)
-                for member in tmpclan.members:
-                    await recruit_queue.put((Reason.DISBANDED, member, clan))
-
-            clans[clan_id] = tmpclan
-            logger.debug("Updated values of Clan %s with ID %d", clan.name, clan.clan_id)
+            if is_unchanged(clan, entry):
+                if scheduler:
+                    scheduler.observe(clan_id, 0)
+                continue
+            updated[clan_id] = Clan(**dict(entry, region=clan.region))
+            stored[clan_id] = clan
         except ValidationError as ve:
             logger.error("Error parsing data: %s with error %s",
                         entry, ve.args)
         except TypeError as te:
             logger.error("Error while parsing member data. Error: %s", te.args)
+
+    clan_ids = list(updated.keys())
+    diffs = diff_batch(clan_ids,
+                       [stored[x].roster for x in clan_ids],
+                       [updated[x].roster for x in clan_ids],
+                       [stored[x].is_clan_disbanded for x in clan_ids],
+                       [updated[x].is_clan_disbanded for x in clan_ids])
+    metrics.CLANS_CHANGED.inc(sum(1 for x in diffs if len(x.left) or len(x.joined) or x.disbanded))
+    if isinstance(clans, CompactClans):
+        await clans.load_details([x.clan_id for x in diffs if len(x.left) > 0])
+    leavers = {}
+    for diff in diffs:
+        if len(diff.left) > 0:
+            members = {x.account_id: x for x in stored[diff.clan_id].members}
+            leavers[diff.clan_id] = []
+            for account_id in diff.left.tolist():
+                if account_id not in members:
+                    # the stored row is gone, the clan was deleted from the data file
+                    logger.warning("No stored details of member %d of clan %s, skipping",
+                                   account_id, diff.clan_id)
+                    continue
+                leavers[diff.clan_id].append(members[account_id])
+    # every player of the response is checked against dedup at once
+    repeats = set()
+    if dedup is not None:
+        candidates = [x.account_id for group in leavers.values() for x in group]
+        candidates += [x.account_id for diff in diffs if diff.disbanded for x in updated[diff.clan_id].members]
+        if candidates:
+            repeats = await dedup.seen_many(candidates)
+
+    def is_repeat(account_id: int) -> bool:
+        if dedup is None:
+            return False
+        if account_id in repeats:
+            return True
+        repeats.add(account_id)
+        return False
+
+    for diff in diffs:
+        clan = stored[diff.clan_id]
+        tmpclan = updated[diff.clan_id]
+        if scheduler:
+            scheduler.observe(diff.clan_id, len(diff.left))
+        for member in leavers.get(diff.clan_id, []):
+            logger.info("Found member %s that left the clan: %s",
+                        member.account_name, tmpclan.name)
+            if is_repeat(member.account_id):
+                logger.info("Already notified about %s recently", member.account_name)
+                continue
+            metrics.RECRUITS_FOUND.labels(Reason.LEFT).inc()
+            await recruit_queue.put(Recruit(reason=Reason.LEFT, member=member,
+                                            clan_id=tmpclan.clan_id, clan_name=tmpclan.name,
+                                            region=tmpclan.region))
+        if len(diff.joined) > 0:
+            logger.debug("%d members joined clan %s", len(diff.joined), tmpclan.name)
+        if diff.disbanded:
+            logger.info("Clan %s disbanded, All members are potential recruits", tmpclan.name)
+            for member in tmpclan.members:
+                if is_repeat(member.account_id):
+                    continue
+                metrics.RECRUITS_FOUND.labels(Reason.DISBANDED).inc()
+                await recruit_queue.put(Recruit(reason=Reason.DISBANDED, member=member,
+                                                clan_id=tmpclan.clan_id, clan_name=tmpclan.name,
+                                                region=tmpclan.region))
+
+        if diff.clan_id not in clans:
+            # no longer watched since a reload
+            continue
+        if changed is not None and has_changed(clan, tmpclan, diff):
+            changed.add(diff.clan_id)
+        clans[diff.clan_id] = tmpclan
+        logger.debug("Updated values of Clan %s with ID %d", tmpclan.name, tmpclan.clan_id)
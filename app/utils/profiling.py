@@ -0,0 +1,148 @@
+"""On-demand sampling profiler and trace spans of the poll pipeline.
+Profiling is switched on at runtime for a number of seconds, when it ends the samples are
+written as collapsed stacks (speedscope, flamegraph.pl, inferno) and the spans in the
+Chrome trace event format (Perfetto, chrome://tracing, speedscope)"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from utils.const import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+MAX_PROFILE_SECONDS = 3600
+
+class Profiler:
+    """Samples the stack of the event loop thread from a background thread
+    and collects spans while active. Spans cost a single attribute check otherwise"""
+    def __init__(self, directory: str = ".", interval: float = 0.005):
+        self.directory = directory
+        self.interval = interval
+        self.active = False
+        self._stacks = Counter()
+        self._events = []
+        self._tasks = {}
+        self._thread = None
+        self._timer = None
+        self._started = 0.0
+
+    def start(self, seconds: float) -> bool:
+        """Profile the calling event loop for seconds, returns False when already profiling"""
+        if self.active:
+            logger.warning("Profiling is already running")
+            return False
+        self._stacks, self._events, self._tasks = Counter(), [], {}
+        self._started = time.perf_counter()
+        self.active = True
+        self._thread = threading.Thread(target=self._sample, args=(threading.get_ident(),),
+                                        name="profiler", daemon=True)
+        self._thread.start()
+        self._timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+        logger.info("Profiling for %.0f seconds", seconds)
+        return True
+
+    def stop(self) -> None:
+        """End profiling and write the results"""
+        if not self.active:
+            return
+        self.active = False
+        self._timer.cancel()
+        self._thread.join()
+        name = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        try:
+            with open(f"{name}.folded", "w", encoding="utf-8") as file:
+                for stack, count in self._stacks.most_common():
+                    file.write(f"{stack} {count}\n")
+            with open(f"{name}.trace.json", "w", encoding="utf-8") as file:
+                json.dump({"traceEvents": self._events, "displayTimeUnit": "ms"}, file)
+            logger.info("Wrote %d samples to %s.folded and %d spans to %s.trace.json",
+                        sum(self._stacks.values()), name, len(self._events), name)
+        except OSError as e:
+            logger.error("Cannot store profile: %s", e)
+
+    def _sample(self, thread_id: int) -> None:
+        """Count the stacks the event loop thread is in"""
+        while self.active:
+            # pylint: disable=protected-access
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def _tid(self) -> int:
+        """Trace row of the current task, named after it the first time it is seen"""
+        task = asyncio.current_task()
+        name = task.get_name() if task else "event loop"
+        if name not in self._tasks:
+            self._tasks[name] = len(self._tasks) + 1
+            self._events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                                 "tid": self._tasks[name], "args": {"name": name}})
+        return self._tasks[name]
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        """Record the duration of the block as a trace span"""
+        if not self.active:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.active:
+                self._events.append({"name": name, "cat": "pipeline", "ph": "X", "pid": os.getpid(),
+                                     "tid": self._tid(), "ts": (start - self._started) * 1e6,
+                                     "dur": (time.perf_counter() - start) * 1e6, "args": args})
+
+    def record(self, name: str, start: float, **args) -> None:
+        """Record a span that started at start, a time.perf_counter() value, and ends now.
+        Used for waits that begin in one task and end in another"""
+        if not self.active:
+            return
+        end = time.perf_counter()
+        start = max(start, self._started)
+        self._events.append({"name": name, "cat": "pipeline", "ph": "X", "pid": os.getpid(),
+                             "tid": self._tid(), "ts": (start - self._started) * 1e6,
+                             "dur": (end - start) * 1e6, "args": args})
+
+PROFILER = Profiler()
+
+def span(name: str, **args):
+    """Trace span of the global profiler"""
+    return PROFILER.span(name, **args)
+
+def record_span(name: str, start: float, **args) -> None:
+    """Span of the global profiler that started at start"""
+    PROFILER.record(name, start, **args)
+
+def batch_args(params: dict) -> dict:
+    """Span arguments identifying a batch of clans across the pipeline stages"""
+    clan_ids = params.get("clan_id", "")
+    return {"batch": clan_ids.split(",", 1)[0], "clans": clan_ids.count(",") + 1 if clan_ids else 0}
+
+async def profile_handler(request: web.Request) -> web.Response:
+    """POST /profile?seconds=N"""
+    try:
+        seconds = float(request.query.get("seconds", 60))
+    except ValueError:
+        return web.Response(status=400, text="seconds must be a number\n")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return web.Response(status=400, text=f"seconds must be between 0 and {MAX_PROFILE_SECONDS}\n")
+    if not PROFILER.start(seconds):
+        return web.Response(status=409, text="profiling is already running\n")
+    return web.Response(status=202, text=f"profiling for {seconds:.0f} seconds\n")
+
+ROUTES = [web.post("/profile", profile_handler)]
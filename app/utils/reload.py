@@ -0,0 +1,122 @@
+"""Reload of the watched clans from the data file while the bot runs"""
+import asyncio
+import logging
+import os
+import time
+from collections.abc import MutableMapping
+
+from utils.const import LOGGER_NAME, CLAN_DETAILS_URLS, MEMBER_FIELDS, DEFAULT_REGION
+from utils.enums import RequestType, Region
+from utils.fetcher import Request
+from utils.batching import plan_batches
+from utils.inflight import InFlight
+from utils.scheduler import PollScheduler
+from utils.shard import shard_of
+from utils.state import CompactClans
+from utils.storage import stored_ids, read_rows, parse_rows
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def file_signature(filename: str) -> tuple:
+    """Modification time and size of the data file and its sqlite write-ahead log"""
+    signature = []
+    for name in (filename, f"{filename}-wal"):
+        try:
+            stat = os.stat(name)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+class ClanReloader:
+    """Brings the watched clans in line with the data file.
+    Clans that were removed from the file are dropped, clans that were added are read
+    and polled once for a baseline roster. Clans that are already watched keep the
+    roster in memory, only the ids of the stored clans are read for them"""
+    def __init__(self,
+                 clans: MutableMapping,
+                 filename: str,
+                 backend: str,
+                 request_queues: dict[Region, asyncio.Queue],
+                 scheduler: PollScheduler = None,
+                 inflight: InFlight = None,
+                 shard_index: int = 0,
+                 shard_count: int = 1):
+        self.clans = clans
+        self.filename = filename
+        self.backend = backend
+        self.request_queues = request_queues
+        self.scheduler = scheduler
+        self.inflight = inflight
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.signature = file_signature(filename)
+        self._lock = asyncio.Lock()
+
+    async def reload(self, reason: str = "reload") -> tuple[list[str], list[str]]:
+        """Add and remove clans, returns the ids that were added and removed"""
+        async with self._lock:
+            self.signature = file_signature(self.filename)
+            stored = await asyncio.to_thread(stored_ids, self.filename, self.backend)
+            if stored is None:
+                # never drop every clan because the file is briefly missing
+                logger.error("Reload (%s): cannot read %s, keeping the watched clans", reason, self.filename)
+                return [], []
+            stored = {x for x in stored if shard_of(x, self.shard_count) == self.shard_index}
+            new = [x for x in stored if x not in self.clans]
+            rows = await asyncio.to_thread(lambda: list(read_rows(self.filename, new, self.backend)))
+            rows = [x for x in rows if self._polled(x)]
+            removed = [x for x in self.clans if x not in stored]
+            for clan_id in removed:
+                del self.clans[clan_id]
+                if self.scheduler:
+                    self.scheduler.remove_clan(clan_id)
+            if isinstance(self.clans, CompactClans):
+                added = self.clans.add_rows(rows)
+            else:
+                clans = parse_rows(rows)
+                self.clans.update(clans)
+                added = list(clans)
+            if not added and not removed:
+                logger.debug("Reload (%s): watched clans are unchanged", reason)
+                return added, removed
+            logger.info("Reload (%s): added %d clans, removed %d, watching %d clans",
+                        reason, len(added), len(removed), len(self.clans))
+            await self.baseline(added)
+            # scheduled after the baseline is in flight, a regular poll would compare
+            # the new clans with the roster stored in the file
+            if self.scheduler:
+                self.scheduler.add_clans(added)
+            return added, removed
+
+    def _polled(self, row: dict) -> bool:
+        """A clan of a realm without a request queue can't be polled until a restart"""
+        region = (row.get("region") or DEFAULT_REGION).lower()
+        if region in {x.value for x in self.request_queues}:
+            return True
+        logger.warning("Clan %s is in region %s which is not polled, restart the bot to watch it",
+                       row.get("clan_id"), region)
+        return False
+
+    async def baseline(self, clan_ids: list[str]) -> None:
+        """Queue member requests that only record the current roster of new clans"""
+        groups = {}
+        for clan_id in clan_ids:
+            groups.setdefault(self.clans[clan_id].region, []).append(clan_id)
+        for region, group in groups.items():
+            for batch in plan_batches(group, [self.clans[x].members_count for x in group]):
+                if self.inflight is not None:
+                    batch = await self.inflight.admit(batch, region=region)
+                if batch:
+                    params = {'clan_id': ",".join(batch), "fields": MEMBER_FIELDS}
+                    await self.request_queues[region].put(
+                        Request(RequestType.BASELINE, CLAN_DETAILS_URLS[region.value], params, region,
+                                time.perf_counter()))
+
+    async def watch(self, interval: int) -> None:
+        """Reload whenever the data file changed, checked every interval seconds.
+        Checkpoints of the bot itself also change the file, those reloads find nothing to do"""
+        while True:
+            await asyncio.sleep(interval)
+            if file_signature(self.filename) != self.signature:
+                await self.reload("data file changed")
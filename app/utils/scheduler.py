@@ -0,0 +1,120 @@
+"""Per clan poll scheduling based on how often members leave"""
+import heapq
+import itertools
+import logging
+import math
+import statistics
+import time
+
+from models import Clan
+from utils.const import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# departures per second assumed for every clan, roughly one departure a month.
+# keeps dormant clans from being starved completely
+RATE_FLOOR = 1 / (30 * 24 * 60 * 60)
+
+class PollScheduler:
+    """Gives every clan its own poll interval.
+    Poll frequency is proportional to the square root of the observed departure rate,
+    which minimises the average time until a leaver is detected for a fixed request budget.
+    The budget is the same as polling every clan once per update_interval"""
+    def __init__(self,
+                 clans: dict[Clan],
+                 update_interval: int,
+                 min_factor: float = 0.25,
+                 max_factor: float = 4,
+                 smoothing: float = 0.3):
+        self.clans = clans
+        self.update_interval = update_interval
+        self.min_interval = update_interval * min_factor
+        self.max_interval = update_interval * max_factor
+        self.smoothing = smoothing
+        self.rates = {}
+        self.last_poll = {}
+        self._weight_sum = 0.0
+        self._heap = []
+        # heap entries of a clan that was removed and added again are stale
+        self._generation = {}
+        self._generations = itertools.count()
+        self.add_clans(clans.keys())
+
+    def _weight(self, clan_id: str) -> float:
+        return math.sqrt(self.rates.get(clan_id, 0.0) + RATE_FLOOR)
+
+    def add_clans(self, clan_ids) -> None:
+        """Schedule new clans, their first polls are spread over one update interval.
+        Clans that are scheduled already are skipped"""
+        clan_ids = [x for x in clan_ids if x not in self._generation]
+        now = time.monotonic()
+        for i, clan_id in enumerate(clan_ids):
+            self._weight_sum += self._weight(clan_id)
+            self._generation[clan_id] = next(self._generations)
+            due = now + self.update_interval * i / len(clan_ids)
+            heapq.heappush(self._heap, (due, clan_id, self._generation[clan_id]))
+
+    def interval(self, clan_id: str) -> float:
+        """Seconds between two polls of a clan"""
+        if not self.clans:
+            return self.update_interval
+        interval = self._weight_sum * self.update_interval / (len(self.clans) * self._weight(clan_id))
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def tick(self, batch_size: int) -> float:
+        """Seconds between two batches so a full budget is spread evenly over the update interval"""
+        batches = max(1, math.ceil(len(self.clans) / batch_size))
+        return self.update_interval / batches
+
+    def next_batch(self, batch_size: int) -> list[str]:
+        """Pop the batch_size clans that are due first.
+        Clans that are not due yet fill up the batch, so the budget left by clamped
+        intervals is spent on polling the next clans early"""
+        now = time.monotonic()
+        batch = []
+        while self._heap and len(batch) < batch_size:
+            _, clan_id, generation = heapq.heappop(self._heap)
+            if self._generation.get(clan_id) != generation:
+                continue
+            if clan_id not in self.clans:
+                self.remove_clan(clan_id)
+                continue
+            batch.append(clan_id)
+            heapq.heappush(self._heap, (now + self.interval(clan_id), clan_id, generation))
+        return batch
+
+    def remove_clan(self, clan_id: str) -> None:
+        """Forget statistics of a clan that is no longer watched, its heap entry is skipped"""
+        if self._generation.pop(clan_id, None) is None:
+            return
+        self._weight_sum -= self._weight(clan_id)
+        self.rates.pop(clan_id, None)
+        self.last_poll.pop(clan_id, None)
+
+    def observe(self, clan_id: str, departures: int) -> None:
+        """Update the departure rate of a clan with the result of a poll"""
+        now = time.monotonic()
+        last = self.last_poll.get(clan_id)
+        self.last_poll[clan_id] = now
+        if last is None or now <= last:
+            return
+        old_weight = self._weight(clan_id)
+        rate = self.rates.get(clan_id, 0.0)
+        rate += self.smoothing * (departures / (now - last) - rate)
+        self.rates[clan_id] = rate
+        self._weight_sum += self._weight(clan_id) - old_weight
+
+    def report(self) -> None:
+        """Log how the poll budget is distributed"""
+        if not self.clans:
+            return
+        intervals = [self.interval(x) for x in self.clans]
+        rates = [self.rates.get(x, 0.0) for x in self.clans]
+        total_rate = sum(rates)
+        logger.info("Scheduler: median poll interval %.0f seconds, shortest %.0f, longest %.0f",
+                    statistics.median(intervals), min(intervals), max(intervals))
+        if total_rate > 0:
+            # a leaver is detected half an interval after leaving on average
+            latency = sum(r * i for r, i in zip(rates, intervals)) / total_rate / 2
+            logger.info("Scheduler: expected time to detect a leaver %.0f seconds, "
+                        "%.0f with fixed intervals", latency, self.update_interval / 2)
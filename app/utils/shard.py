@@ -0,0 +1,29 @@
+"""Split the watch list over several bot instances"""
+import hashlib
+import logging
+from collections.abc import MutableMapping
+
+from utils.const import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+def shard_of(clan_id: int | str, shard_count: int) -> int:
+    """Shard a clan belongs to.
+    Uses rendezvous hashing, changing the shard count only moves the clans
+    of the shards that were added or removed"""
+    if shard_count <= 1:
+        return 0
+    def score(shard: int) -> int:
+        digest = hashlib.blake2b(f"{shard}:{clan_id}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+    return max(range(shard_count), key=score)
+
+def select_shard(clans: MutableMapping, shard_index: int, shard_count: int) -> None:
+    """Drop the clans that are polled by other instances"""
+    if shard_count <= 1:
+        return
+    total = len(clans)
+    for clan_id in [x for x in clans if shard_of(x, shard_count) != shard_index]:
+        del clans[clan_id]
+    logger.info("Shard %d of %d: watching %d of %d clans",
+                shard_index, shard_count, len(clans), total)
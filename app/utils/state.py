@@ -0,0 +1,202 @@
+"""Compact in-memory clan state for large watch lists"""
+import asyncio
+import logging
+import os
+import sqlite3
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from models import Clan, Member, text_fields_hash
+from utils.const import LOGGER_NAME, DEFAULT_REGION
+from utils.diff import roster_array
+from utils.enums import Region
+from utils.fetcher import json_loads
+from utils.storage import (HEADERS, SQLITE_BATCH_SIZE, clan_row, connect_database,
+                           load_clan, parse_rows, read_rows, write_sqlite)
+
+logger = logging.getLogger(LOGGER_NAME)
+
+class CompactClan:
+    """Clan as kept in memory by CompactClans.
+    Only what is needed to detect changes is stored: a sorted uint32 array of account ids,
+    the scalar fields and a hash of the text fields.
+    Names, descriptions and member details are read from the database when asked for,
+    which only happens when a member left or the clan disbanded"""
+    __slots__ = ("_filename", "_clan", "clan_id", "members_count", "updated_at",
+                 "is_clan_disbanded", "roster", "fields_hash", "region")
+
+    def __init__(self,
+                 filename: str,
+                 clan_id: int,
+                 members_count: int,
+                 updated_at: int,
+                 is_clan_disbanded: bool,
+                 roster: np.ndarray,
+                 fields_hash: int,
+                 region: Region):
+        self._filename = filename
+        self._clan = None
+        self.clan_id = clan_id
+        self.members_count = members_count
+        self.updated_at = updated_at
+        self.is_clan_disbanded = is_clan_disbanded
+        self.roster = roster
+        self.fields_hash = fields_hash
+        self.region = region
+
+    @classmethod
+    def from_clan(cls, filename: str, clan: Clan) -> "CompactClan":
+        """Shrink a validated clan"""
+        return cls(filename, clan.clan_id, clan.members_count, clan.updated_at,
+                   clan.is_clan_disbanded, clan.roster.astype(np.uint32), clan.fields_hash, clan.region)
+
+    @property
+    def loaded(self) -> bool:
+        """the details were read from the database"""
+        return self._clan is not None
+
+    def use_details(self, clan: Clan | None) -> None:
+        """Details read by CompactClans.load_details, a missing row gives an empty clan"""
+        self._clan = clan or Clan(name="", clan_id=self.clan_id)
+
+    def _load(self) -> Clan:
+        if self._clan is None:
+            self._clan = load_clan(self._filename, self.clan_id)
+            if self._clan is None:
+                self._clan = Clan(name="", clan_id=self.clan_id)
+        return self._clan
+
+    @property
+    def name(self) -> str:
+        """clan name, read from the database"""
+        return self._load().name
+
+    @property
+    def tag(self) -> str:
+        """clan tag, read from the database"""
+        return self._load().tag
+
+    @property
+    def old_name(self) -> str:
+        """previous clan name, read from the database"""
+        return self._load().old_name
+
+    @property
+    def description(self) -> str:
+        """clan description, read from the database"""
+        return self._load().description
+
+    @property
+    def members(self) -> list[Member]:
+        """members including names and roles, read from the database"""
+        return self._load().members
+
+class CompactClans(MutableMapping):
+    """Dict of clan id to CompactClan backed by a sqlite data file.
+    Clans stored by the parser are kept as full Clan objects until flush
+    writes them to the database, after which only the compact version stays in memory"""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._clans = {}
+        self._dirty = {}
+
+    def load(self) -> "CompactClans":
+        """Read every stored clan without building pydantic models"""
+        if not os.path.exists(self.filename):
+            logger.error("Data-file error: No such file or directory")
+            return self
+        logger.info("Parsing data file: %s", self.filename)
+        connection = connect_database(self.filename)
+        try:
+            cursor = connection.execute(f"SELECT {','.join(HEADERS)} FROM clans")
+            while rows := cursor.fetchmany(SQLITE_BATCH_SIZE):
+                for row in rows:
+                    self._add_row(dict(zip(HEADERS, row)))
+        except sqlite3.Error as se:
+            logger.error("Data-file error: %s", se)
+        finally:
+            connection.close()
+        return self
+
+    def add_rows(self, rows) -> list[str]:
+        """Add stored rows of clans read after loading, returns the ids that were added.
+        They are stored already and not written back until they change"""
+        added = []
+        for row in rows:
+            if self._add_row(row):
+                added.append(str(row['clan_id']))
+        return added
+
+    def _add_row(self, row: dict) -> bool:
+        """Add a stored row, the stored text is already stripped by the Clan model"""
+        try:
+            members = json_loads(row['members'] or '[]')
+            clan = CompactClan(self.filename,
+                               int(row['clan_id']),
+                               int(row['members_count'] or 0),
+                               int(row['updated_at'] or 0),
+                               bool(row['is_clan_disbanded']),
+                               roster_array((int(x['account_id']) for x in members), np.uint32),
+                               text_fields_hash(row['name'], row['tag'] or "",
+                                                row['old_name'] or "", row['description'] or ""),
+                               Region((row['region'] or DEFAULT_REGION).lower()))
+            self._clans[str(clan.clan_id)] = clan
+            return True
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error("Parsing Error. Line: %s, Error: %s", row, e)
+            return False
+
+    def __getitem__(self, clan_id: str) -> Clan | CompactClan:
+        if clan_id in self._dirty:
+            return self._dirty[clan_id]
+        return self._clans[clan_id]
+
+    def __setitem__(self, clan_id: str, clan: Clan) -> None:
+        self._dirty[clan_id] = clan
+        self._clans[clan_id] = CompactClan.from_clan(self.filename, clan)
+
+    def __delitem__(self, clan_id: str) -> None:
+        self._dirty.pop(clan_id, None)
+        del self._clans[clan_id]
+
+    def __iter__(self):
+        return iter(self._clans)
+
+    def __len__(self) -> int:
+        return len(self._clans)
+
+    def __contains__(self, clan_id) -> bool:
+        return clan_id in self._clans
+
+    async def load_details(self, clan_ids: list[str]) -> None:
+        """Read names and members of several clans with one query in a worker thread,
+        instead of a query per clan inside the event loop when a recruit is found"""
+        pending = [x for x in clan_ids if x in self._clans and x not in self._dirty
+                   and not self._clans[x].loaded]
+        if not pending:
+            return
+        try:
+            details = await asyncio.to_thread(
+                lambda: parse_rows(read_rows(self.filename, pending, "sqlite")))
+        except sqlite3.Error as se:
+            logger.error("Cannot read clan details: %s", se)
+            return
+        for clan_id in pending:
+            if clan_id in self._clans and clan_id not in self._dirty:
+                self._clans[clan_id].use_details(details.get(clan_id))
+
+    def flush(self) -> None:
+        """Write clans that changed since the previous flush to the database.
+        Runs in the event loop, a lazy load during the write would otherwise read the old row"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            # clans deleted from the file wait for the next reload, don't add them again
+            write_sqlite(self.filename, (clan_row(x) for x in dirty.values()), update_only=True)
+            logger.info("Checkpointed %d changed clans to %s", len(dirty), self.filename)
+        except (PermissionError, sqlite3.Error) as e:
+            logger.error("Cannot Store current clan info: %s", e)
+            # keep them, the next flush tries again
+            self._dirty = dirty | self._dirty
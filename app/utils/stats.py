@@ -0,0 +1,69 @@
+"""Counters describing the work done in a poll cycle"""
+import logging
+from dataclasses import dataclass
+
+from utils.const import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+@dataclass
+class PollStats:
+    """Traffic and parse time of a poll cycle, used to report what two-phase polling saves"""
+    summary_bytes: int = 0
+    summary_clans: int = 0
+    member_bytes: int = 0
+    member_clans: int = 0
+    member_parse_time: float = 0.0
+    skipped_clans: int = 0
+    # running averages over all cycles, a cycle can skip every clan
+    bytes_per_clan: float = 0.0
+    parse_time_per_clan: float = 0.0
+
+    def record_summary(self, size: int, clans: int, changed: int) -> None:
+        """Register a response containing only the cheap fields"""
+        self.summary_bytes += size
+        self.summary_clans += clans
+        self.skipped_clans += clans - changed
+
+    def record_members(self, size: int, clans: int, parse_time: float) -> None:
+        """Register a response containing full member lists"""
+        self.member_bytes += size
+        self.member_clans += clans
+        self.member_parse_time += parse_time
+        if clans > 0:
+            weight = 0.1
+            if self.bytes_per_clan == 0:
+                weight = 1.0
+            self.bytes_per_clan += weight * (size / clans - self.bytes_per_clan)
+            self.parse_time_per_clan += weight * (parse_time / clans - self.parse_time_per_clan)
+
+    @property
+    def saved_bytes(self) -> int:
+        """bytes that were not downloaded compared to fetching every clan in full"""
+        return int(self.skipped_clans * self.bytes_per_clan) - self.summary_bytes
+
+    @property
+    def saved_parse_time(self) -> float:
+        """seconds not spent parsing member lists of unchanged clans"""
+        return self.skipped_clans * self.parse_time_per_clan
+
+    def report(self) -> None:
+        """Log the numbers of the finished cycle"""
+        if self.summary_clans == 0 and self.member_clans == 0:
+            return
+        if self.summary_clans > 0:
+            logger.info("Poll cycle: %d of %d clans unchanged, saved %d bytes and %.3f seconds of parsing",
+                        self.skipped_clans, self.summary_clans,
+                        self.saved_bytes, self.saved_parse_time)
+        logger.info("Poll cycle: received %d bytes for %d full clans, %.3f seconds parsing",
+                    self.member_bytes + self.summary_bytes, self.member_clans,
+                    self.member_parse_time)
+
+    def reset(self) -> None:
+        """Start counting a new cycle, running averages are kept"""
+        self.summary_bytes = 0
+        self.summary_clans = 0
+        self.member_bytes = 0
+        self.member_clans = 0
+        self.member_parse_time = 0.0
+        self.skipped_clans = 0
@@ -1,54 +1,335 @@
-"""functions used to read and write to csv file"""
+"""functions used to read and write clan data to csv or sqlite files"""
 import logging
 import csv
 import json
+import os
+import sqlite3
+import asyncio
 
-from typing import List
+from typing import Iterable, Iterator, List
 from pydantic import ValidationError
 from models import Clan
 from utils.const import LOGGER_NAME
 
 logger = logging.getLogger(LOGGER_NAME)
 
-def read_file(filename: str) -> List[Clan]:
+HEADERS = ["name", "clan_id", "tag", "is_clan_disbanded",
+           "old_name", "members_count", "description", "members", "updated_at", "region"]
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+SQLITE_BATCH_SIZE = 1000
+SQLITE_TIMEOUT = 30
+BACKENDS = ["auto", "csv", "sqlite"]
+
+def storage_backend(filename: str, backend: str = "auto") -> str:
+    """Determine which storage backend to use for a file"""
+    if backend != "auto":
+        return backend
+    if filename and filename.lower().endswith(SQLITE_EXTENSIONS):
+        return "sqlite"
+    return "csv"
+
+def _parse_row(row: dict, clans: dict[Clan]) -> None:
+    """Validate a single stored row and add it to the clan dict"""
+    try:
+        logger.debug("File Contents: %s", row)
+        row['members'] = json.loads(row.get('members') or '[]')
+        clan = Clan(**row)
+        clans[str(clan.clan_id)] = clan
+        logger.debug("Clan object content: %s", clan)
+    except (ValidationError, json.JSONDecodeError) as ve:
+        logger.error("Parsing Error. Line: %s, Error: %s", row, ve)
+
+def clan_row(clan: Clan) -> dict:
+    """Serialize a clan to a flat dict containing the stored columns"""
+    clan_dict = clan.model_dump()
+    return dict((k, clan_dict[k]) for k in HEADERS if k in clan_dict)
+
+def read_file(filename: str, backend: str = "auto") -> List[Clan]:
     """ read file contain clan names and store it in a dataframe"""
+    backend = storage_backend(filename, backend)
+    logger.info("Parsing data file: %s", filename)
+    if backend == "sqlite":
+        return _read_sqlite(filename)
+    return _read_csv(filename)
+
+def _read_csv(filename: str) -> dict[Clan]:
     try:
-        logger.info("Parsing data file: %s", filename)
         with open(filename, "r", encoding="utf-8") as csvfile:
             reader = csv.DictReader(csvfile)
             clans = {}
             for row in reader:
-                try:
-                    logger.debug("File Contents: %s", row)
-                    if row.get('members'):
-                        row['members'] = json.loads(row.get('members'))
-                    clan = Clan(**row)
-                    clans[str(clan.clan_id)] = clan
-                    logger.debug("Clan object content: %s", clan)
-                except (ValidationError, json.JSONDecodeError) as ve:
-                    logger.error("Parsing Error. Line: %s, Error: %s", row, ve)
+                _parse_row(row, clans)
             return clans
     except FileNotFoundError as fnfe:
         logger.error("Data-file error: %s", fnfe.args[1])
         return {}
 
-def store_file(clans: dict[Clan], filename: str) -> None:
-    """Write current dataframe to csv file"""
+def connect_database(filename: str) -> sqlite3.Connection:
+    """Open the database and make sure the clan table exists"""
+    # several bot instances can share a database, wait for the other writers
+    connection = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS clans ("
+                       "clan_id INTEGER PRIMARY KEY, name TEXT, tag TEXT, "
+                       "is_clan_disbanded INTEGER, old_name TEXT, members_count INTEGER, "
+                       "description TEXT, members TEXT, updated_at INTEGER, region TEXT)")
+    # databases created by older versions miss newer columns
+    columns = [x[1] for x in connection.execute("PRAGMA table_info(clans)")]
+    if "updated_at" not in columns:
+        connection.execute("ALTER TABLE clans ADD COLUMN updated_at INTEGER")
+    if "region" not in columns:
+        connection.execute("ALTER TABLE clans ADD COLUMN region TEXT")
+    return connection
+
+def load_clan(filename: str, clan_id: int) -> Clan | None:
+    """Read a single clan from the database"""
+    connection = connect_database(filename)
+    try:
+        connection.row_factory = sqlite3.Row
+        row = connection.execute(f"SELECT {','.join(HEADERS)} FROM clans WHERE clan_id=?",
+                                 (clan_id,)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    clans = {}
+    _parse_row(dict(row), clans)
+    return clans.get(str(clan_id))
+
+def _read_sqlite(filename: str) -> dict[Clan]:
+    """Parse every clan with its members at once.
+    Rows are fetched in batches, which only bounds the raw rows held while parsing.
+    Use CompactClans to read member details on demand"""
+    if not os.path.exists(filename):
+        logger.error("Data-file error: No such file or directory")
+        return {}
+    clans = {}
+    connection = connect_database(filename)
+    try:
+        connection.row_factory = sqlite3.Row
+        cursor = connection.execute(f"SELECT {','.join(HEADERS)} FROM clans")
+        while rows := cursor.fetchmany(SQLITE_BATCH_SIZE):
+            for row in rows:
+                _parse_row(dict(row), clans)
+    except sqlite3.Error as se:
+        logger.error("Data-file error: %s", se)
+    finally:
+        connection.close()
+    return clans
+
+def write_sqlite(filename: str, rows: Iterable[dict], update_only: bool = False) -> None:
+    """Upsert rows, committing a transaction per batch.
+    With update_only rows that are no longer stored are not added again"""
+    columns = ",".join(HEADERS)
+    placeholders = ",".join(f":{x}" for x in HEADERS)
+    updates = ",".join(f"{x}=excluded.{x}" for x in HEADERS if x != "clan_id")
+    query = f"INSERT INTO clans ({columns}) VALUES ({placeholders}) "\
+            f"ON CONFLICT(clan_id) DO UPDATE SET {updates}"
+    if update_only:
+        updates = ",".join(f"{x}=:{x}" for x in HEADERS if x != "clan_id")
+        query = f"UPDATE clans SET {updates} WHERE clan_id=:clan_id"
+    connection = connect_database(filename)
+    try:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= SQLITE_BATCH_SIZE:
+                with connection:
+                    connection.executemany(query, batch)
+                batch = []
+        if batch:
+            with connection:
+                connection.executemany(query, batch)
+    finally:
+        connection.close()
+
+def _write_csv(filename: str, rows: Iterable[dict]) -> None:
+    """Write all rows to a temporary file and swap it in, so a crash never leaves half a file"""
+    tmpfile = f"{filename}.tmp"
+    with open(tmpfile, "w", encoding="utf-8") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=HEADERS, delimiter=',')
+        writer.writeheader()
+        logger.debug("Writeing file, headers found: %s", HEADERS)
+        for row in rows:
+            logger.debug("Clan object to dict Content: %s", row)
+            writer.writerow(row)
+    os.replace(tmpfile, filename)
+
+def iter_rows(filename: str, backend: str = "auto") -> Iterator[dict]:
+    """Stream stored rows without validating them, columns missing from older files are None"""
+    if storage_backend(filename, backend) == "sqlite":
+        connection = connect_database(filename)
+        try:
+            cursor = connection.execute(f"SELECT {','.join(HEADERS)} FROM clans")
+            while rows := cursor.fetchmany(SQLITE_BATCH_SIZE):
+                for row in rows:
+                    yield dict(zip(HEADERS, row))
+        finally:
+            connection.close()
+        return
+    with open(filename, "r", encoding="utf-8") as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield {x: row.get(x) for x in HEADERS}
+
+def stored_ids(filename: str, backend: str = "auto") -> set[str] | None:
+    """Ids of every stored clan, None when the data file can't be read"""
+    try:
+        if storage_backend(filename, backend) == "sqlite":
+            if not os.path.exists(filename):
+                raise FileNotFoundError(filename)
+            connection = connect_database(filename)
+            try:
+                return {str(x) for x, in connection.execute("SELECT clan_id FROM clans")}
+            finally:
+                connection.close()
+        with open(filename, "r", encoding="utf-8") as csvfile:
+            return {row.get("clan_id") for row in csv.DictReader(csvfile)}
+    except (OSError, sqlite3.Error, csv.Error) as e:
+        logger.error("Data-file error: %s", e)
+        return None
+
+def read_rows(filename: str, clan_ids: Iterable[str], backend: str = "auto") -> Iterator[dict]:
+    """Stream the stored rows of some clans, see iter_rows"""
+    clan_ids = set(clan_ids)
+    if not clan_ids:
+        return
+    if storage_backend(filename, backend) != "sqlite":
+        yield from (row for row in iter_rows(filename, backend) if row["clan_id"] in clan_ids)
+        return
+    connection = connect_database(filename)
+    try:
+        clan_ids = sorted(int(x) for x in clan_ids)
+        # stay below the variable limit of older sqlite versions
+        for i in range(0, len(clan_ids), SQLITE_BATCH_SIZE // 2):
+            batch = clan_ids[i:i + SQLITE_BATCH_SIZE // 2]
+            cursor = connection.execute(f"SELECT {','.join(HEADERS)} FROM clans "
+                                        f"WHERE clan_id IN ({','.join('?' * len(batch))})", batch)
+            for row in cursor:
+                yield dict(zip(HEADERS, row))
+    finally:
+        connection.close()
+
+def parse_rows(rows: Iterable[dict]) -> dict[Clan]:
+    """Validate raw rows, see iter_rows"""
+    clans = {}
+    for row in rows:
+        _parse_row(row, clans)
+    return clans
+
+def _sqlite_row(row: dict) -> dict:
+    """csv files store booleans as True/False text, sqlite as integers"""
+    disbanded = row.get("is_clan_disbanded")
+    if isinstance(disbanded, str):
+        row = dict(row, is_clan_disbanded=int(disbanded.strip().lower() in ("true", "1")))
+    return row
+
+def store_rows(rows: Iterable[dict], filename: str, backend: str = "auto") -> None:
+    """Write raw rows to the data file, see iter_rows"""
+    try:
+        if storage_backend(filename, backend) == "sqlite":
+            write_sqlite(filename, (_sqlite_row(x) for x in rows))
+        else:
+            _write_csv(filename, rows)
+        logger.info("Saved clan list to %s", filename)
+    except PermissionError as pe:
+        logger.error("Cannot Store current clan info: %s", pe.args[1])
+    except sqlite3.Error as se:
+        logger.error("Cannot Store current clan info: %s", se)
+
+def store_file(clans: dict[Clan], filename: str, backend: str = "auto", update_only: bool = False) -> bool:
+    """Write all clans to the data file, returns False when they could not be written.
+    With update_only clans that were deleted from a sqlite file are not stored again"""
     if len(clans) == 0:
         logger.error("Cannot store empty list")
-        return
+        return False
     try:
-        with open(filename, "w", encoding="utf-8") as csvfile:
-            headers = ["name", "clan_id", "tag", "is_clan_disbanded",
-                       "old_name","members_count", "description","members"]
-            writer = csv.DictWriter(csvfile, fieldnames=headers, delimiter=',')
-            writer.writeheader()
-            logger.debug("Writeing file, headers found: %s", headers)
-            for clan in clans.values():
-                clan_dict = clan.model_dump()
-                filtered_dict = dict((k, clan_dict[k]) for k in headers if k in clan_dict)
-                logger.debug("Clan object to dict Content: %s", filtered_dict)
-                writer.writerow(filtered_dict)
+        rows = (clan_row(clan) for clan in clans.values())
+        if storage_backend(filename, backend) == "sqlite":
+            write_sqlite(filename, rows, update_only)
+        else:
+            _write_csv(filename, rows)
         logger.info("Saved Current clan list to %s", filename)
+        return True
     except PermissionError as pe:
         logger.error("Cannot Store current clan info: %s", pe.args[1])
+    except sqlite3.Error as se:
+        logger.error("Cannot Store current clan info: %s", se)
+    return False
+
+def truncate_file(filename: str, size: int) -> None:
+    """Cut a file back to size bytes, written rows after size are dropped"""
+    try:
+        with open(filename, "rb+") as file:
+            end = file.seek(0, os.SEEK_END)
+            if end > size:
+                logger.warning("Removing %d bytes written after the last checkpoint from %s", end - size, filename)
+                file.truncate(size)
+    except FileNotFoundError:
+        return
+
+def trim_partial_line(filename: str, chunk_size: int = 64 * 1024) -> None:
+    """Cut a csv file back to its last row terminator, the last row is cut off
+    when a crawl was killed while writing it. Descriptions can hold newlines,
+    only the \\r\\n the csv writer ends rows with is searched for"""
+    try:
+        with open(filename, "rb+") as file:
+            end = file.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(0, position - chunk_size)
+                file.seek(start)
+                # overlap by a byte, a terminator can span two chunks
+                newline = file.read(min(position + 1, end) - start).rfind(b"\r\n")
+                if newline != -1:
+                    position = start + newline + 2
+                    break
+                position = start
+            if position < end:
+                logger.warning("Removing %d bytes of an incomplete row from %s", end - position, filename)
+                file.truncate(position)
+    except FileNotFoundError:
+        return
+
+def append_file(clans: dict[Clan], filename: str, backend: str = "auto") -> bool:
+    """Add clans to the data file without rewriting what is already stored.
+    Returns False when the clans could not be written"""
+    rows = (clan_row(clan) for clan in clans.values())
+    try:
+        if storage_backend(filename, backend) == "sqlite":
+            write_sqlite(filename, rows)
+            return True
+        new_file = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        with open(filename, "a", encoding="utf-8") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=HEADERS, delimiter=',')
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+        return True
+    except PermissionError as pe:
+        logger.error("Cannot Store current clan info: %s", pe.args[1])
+    except sqlite3.Error as se:
+        logger.error("Cannot Store current clan info: %s", se)
+    return False
+
+async def store_changes(clans: dict[Clan],
+                        changed: set[str],
+                        filename: str,
+                        backend: str = "auto") -> bool:
+    """Persist the clans that changed since the last checkpoint.
+    The sqlite backend only updates those rows, a clan deleted from the file while the
+    bot runs stays deleted. csv files are rewritten completely.
+    Returns False when nothing was written, the clans have to be stored again"""
+    if len(changed) == 0:
+        return True
+    if storage_backend(filename, backend) != "sqlite":
+        return await asyncio.to_thread(store_file, dict(clans), filename, backend)
+    # serialize inside the event loop, the parser keeps replacing clans while we write
+    rows = [clan_row(clans[x]) for x in changed if x in clans]
+    try:
+        await asyncio.to_thread(write_sqlite, filename, rows, True)
+        logger.info("Checkpointed %d changed clans to %s", len(rows), filename)
+        return True
+    except (PermissionError, sqlite3.Error) as e:
+        logger.error("Cannot Store current clan info: %s", e)
+        return False